@@ -0,0 +1,269 @@
+import subprocess
+import statistics
+import argparse
+import shlex
+import tempfile
+import shutil
+import json
+import time
+import csv
+import sys
+import os
+
+'''
+  reproducible benchmark suite
+
+  runs a declared matrix of image sizes x optimizers x style layer sets
+  (benchmarks.json) on the bundled images with seeded random vgg weights,
+  so no .mat file is needed.  every case runs in a fresh process and
+  reports setup time, time per iteration, time to reach a loss threshold
+  and peak rss.  results are written as json and csv and can be compared
+  against a stored baseline to flag regressions.
+
+  python3 benchmark.py --output bench/results --save_baseline bench/baseline.json
+  python3 benchmark.py --output bench/results --baseline bench/baseline.json
+'''
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+# metrics compared against the baseline; larger is worse for all of them
+COMPARED_METRICS = ['setup_time', 'iteration_time', 'time_to_threshold', 'peak_rss_mib',
+  'final_loss']
+
+def parse_args():
+  desc = 'Benchmark neural_style.py over a matrix of sizes, optimizers and style layers.'
+  parser = argparse.ArgumentParser(description=desc)
+
+  parser.add_argument('--matrix', type=str,
+    default='benchmarks.json',
+    help='JSON file declaring the benchmark matrix. (default: %(default)s)')
+
+  parser.add_argument('--sizes', nargs='+', type=int,
+    help='Only run these image sizes from the matrix.')
+
+  parser.add_argument('--optimizers', nargs='+', type=str,
+    help='Only run these optimizers from the matrix.')
+
+  parser.add_argument('--output', type=str,
+    default='bench_results',
+    help='Path prefix of the .json and .csv results. (default: %(default)s)')
+
+  parser.add_argument('--baseline', type=str,
+    help='Results JSON to compare against; regressions make the exit code 1.')
+
+  parser.add_argument('--tolerance', type=float,
+    default=0.1,
+    help='Relative slowdown or memory growth over the baseline flagged as a regression. (default: %(default)s)')
+
+  parser.add_argument('--case_args', type=str,
+    default='',
+    help='Extra neural_style.py options added to every case, e.g. --case_args="--xla".')
+
+  parser.add_argument('--save_baseline', type=str,
+    help='Also write the results JSON to this path as the new baseline.')
+
+  parser.add_argument('--verbose', action='store_true',
+    help='Boolean flag indicating if the benchmarked runs should print to the console.')
+
+  # internal: run one case in this process and print its result
+  parser.add_argument('--run_case', type=str,
+    help=argparse.SUPPRESS)
+
+  return parser.parse_args()
+
+def get_cases(matrix, sizes=None, optimizers=None, case_args=''):
+  cases = []
+  for size in matrix['sizes']:
+    if sizes is not None and size not in sizes:
+      continue
+    for optimizer in matrix['optimizers']:
+      if optimizers is not None and optimizer not in optimizers:
+        continue
+      for set_name in sorted(matrix['style_layer_sets']):
+        cases.append({
+          'name': '{}-{}-{}'.format(size, optimizer, set_name),
+          'size': size,
+          'optimizer': optimizer,
+          'style_layer_set': set_name,
+          'style_layers': matrix['style_layer_sets'][set_name],
+          'content_img': matrix['content_img'],
+          'style_img': matrix['style_img'],
+          'max_iterations': matrix['max_iterations'],
+          'loss_ratio': matrix['loss_ratio'],
+          'seed': matrix.get('seed', 0),
+          'mem_interval': matrix.get('mem_interval', 0.01),
+          'extra_args': matrix.get('extra_args', []) + shlex.split(case_args)})
+  return cases
+
+'''
+  single case (runs in its own process)
+'''
+def run_case(case, verbose):
+  import resource
+  tick = time.time()
+  import neural_style as ns
+  import_time = time.time() - tick
+  ns.tf.compat.v1.logging.set_verbosity(ns.tf.compat.v1.logging.ERROR)
+
+  out_dir = tempfile.mkdtemp(prefix='style-bench-')
+  try:
+    argv = [
+      '--content_img', case['content_img'],
+      '--style_imgs', case['style_img'],
+      '--max_size', str(case['size']),
+      '--optimizer', case['optimizer'],
+      '--max_iterations', str(case['max_iterations']),
+      '--style_layers'] + case['style_layers'] + [
+      '--style_layer_weights'] + ['1.0'] * len(case['style_layers']) + [
+      '--model_weights', 'random',
+      '--seed', str(case['seed']),
+      '--no_gram_cache',
+      '--img_output_dir', out_dir,
+      '--output_workers', '0',
+      '--mem', '--mem_interval', str(case['mem_interval'])] + case['extra_args']
+    if verbose:
+      argv.append('--verbose')
+    ns.args = ns.parse_args(argv)
+    start = time.time()
+    ns.render_image()
+    total_time = time.time() - start
+  finally:
+    ns.close_stylizers()
+    ns.close_outputs()
+    shutil.rmtree(out_dir, ignore_errors=True)
+
+  iterations = max(1, ns.run_info.get('stop_iteration', case['max_iterations']))
+  optimize_time = ns.time_vec[-1]
+  threshold = ns.loss_vec[0] * case['loss_ratio']
+  time_to_threshold = None
+  for t, loss in zip(ns.time_vec, ns.loss_vec):
+    if loss <= threshold:
+      time_to_threshold = t
+      break
+  return {
+    'name': case['name'],
+    'size': case['size'],
+    'optimizer': case['optimizer'],
+    'style_layer_set': case['style_layer_set'],
+    'import_time': import_time,
+    'setup_time': ns.time_start - start,
+    'optimize_time': optimize_time,
+    'total_time': total_time,
+    'iterations': iterations,
+    'iteration_time': optimize_time / iterations,
+    'initial_loss': float(ns.loss_vec[0]),
+    'final_loss': float(ns.loss_vec[-1]),
+    'time_to_threshold': time_to_threshold,
+    # getrusage reports the exact high-water mark, in KiB on linux
+    'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    'peak_rss_optimize_mib': max(ns.mem_vec) if ns.mem_vec else None}
+
+def run_case_process(case, verbose):
+  cmd = [sys.executable, os.path.abspath(__file__), '--run_case', json.dumps(case)]
+  if verbose:
+    cmd.append('--verbose')
+  proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+  result = None
+  for line in proc.stdout.splitlines():
+    if line.startswith(RESULT_PREFIX):
+      result = json.loads(line[len(RESULT_PREFIX):])
+    elif verbose:
+      print(line)
+  if proc.returncode != 0 or result is None:
+    raise RuntimeError('benchmark case {} failed (exit code {})'.format(case['name'], proc.returncode))
+  return result
+
+def median_result(results):
+  merged = dict(results[0])
+  for key, value in results[0].items():
+    values = [r[key] for r in results]
+    if isinstance(value, float) and None not in values:
+      merged[key] = statistics.median(values)
+  merged['repeats'] = len(results)
+  return merged
+
+'''
+  reporting
+'''
+def write_results(results, prefix):
+  out_dir = os.path.dirname(prefix)
+  if out_dir and not os.path.exists(out_dir):
+    os.makedirs(out_dir)
+  with open(prefix + '.json', 'w') as f:
+    json.dump(results, f, indent=2)
+  with open(prefix + '.csv', 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+    writer.writeheader()
+    writer.writerows(results)
+
+def compare_results(results, baseline, tolerance):
+  by_name = dict((r['name'], r) for r in baseline)
+  regressions = []
+  for result in results:
+    base = by_name.get(result['name'])
+    if base is None:
+      continue
+    for metric in COMPARED_METRICS:
+      new, old = result.get(metric), base.get(metric)
+      if new is None or old is None or old <= 0.:
+        continue
+      change = (new - old) / old
+      if change > tolerance:
+        regressions.append((result['name'], metric, old, new, change))
+  return regressions
+
+def print_results(results):
+  print('{:<24} {:>9} {:>11} {:>11} {:>10} {:>12}'.format('case', 'setup(s)',
+    'iter(ms)', 'to_thr(s)', 'rss(MiB)', 'final_loss'))
+  for r in results:
+    to_threshold = '-' if r['time_to_threshold'] is None else '{:.2f}'.format(r['time_to_threshold'])
+    print('{:<24} {:>9.2f} {:>11.1f} {:>11} {:>10.0f} {:>12.4g}'.format(r['name'],
+      r['setup_time'], 1000. * r['iteration_time'], to_threshold, r['peak_rss_mib'],
+      r['final_loss']))
+
+def print_comparison(results, baseline):
+  # side by side with the baseline, e.g. a reduced precision run against float32
+  by_name = dict((r['name'], r) for r in baseline)
+  print('{:<24} {:>10} {:>10} {:>12}'.format('case', 'iter', 'rss', 'final_loss'))
+  for r in results:
+    base = by_name.get(r['name'])
+    if base is None:
+      continue
+    print('{:<24} {:>+10.1%} {:>+10.1%} {:>+12.2%}'.format(r['name'],
+      r['iteration_time'] / base['iteration_time'] - 1.,
+      r['peak_rss_mib'] / base['peak_rss_mib'] - 1.,
+      r['final_loss'] / base['final_loss'] - 1.))
+
+def main():
+  bench_args = parse_args()
+  if bench_args.run_case is not None:
+    result = run_case(json.loads(bench_args.run_case), bench_args.verbose)
+    print(RESULT_PREFIX + json.dumps(result))
+    return
+
+  with open(bench_args.matrix) as f:
+    matrix = json.load(f)
+  cases = get_cases(matrix, bench_args.sizes, bench_args.optimizers, bench_args.case_args)
+  results = []
+  for case in cases:
+    print('running {} ({} repeats)...'.format(case['name'], matrix.get('repeats', 1)))
+    runs = [run_case_process(case, bench_args.verbose) for _ in range(matrix.get('repeats', 1))]
+    results.append(median_result(runs))
+  write_results(results, bench_args.output)
+  if bench_args.save_baseline is not None:
+    with open(bench_args.save_baseline, 'w') as f:
+      json.dump(results, f, indent=2)
+  print_results(results)
+
+  if bench_args.baseline is not None:
+    with open(bench_args.baseline) as f:
+      baseline = json.load(f)
+    print_comparison(results, baseline)
+    regressions = compare_results(results, baseline, bench_args.tolerance)
+    for name, metric, old, new, change in regressions:
+      print('REGRESSION {} {}: {:.4g} -> {:.4g} (+{:.0%})'.format(name, metric, old, new, change))
+    if regressions:
+      sys.exit(1)
+    print('no regressions against {}'.format(bench_args.baseline))
+
+if __name__ == '__main__':
+  main()
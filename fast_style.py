@@ -0,0 +1,302 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+import random
+import json
+import time
+import cv2
+import os
+
+import neural_style as ns
+
+'''
+  feed-forward style transfer
+
+  trains a small image transformation network for one style, using the
+  vgg-19 from neural_style.py as a fixed loss network with the same
+  content, style and total variation losses, then stylizes images with a
+  single forward pass of that network.
+
+  python3 fast_style.py train --train_dir ./coco --model_dir ./models/starry-night --style_imgs starry-night.jpg
+  python3 fast_style.py stylize --model_dir ./models/starry-night --input_dir ./image_input --output_dir ./image_output/fast
+
+  options not listed below (loss weights, layers, --backbone, --model_weights, --device,
+  --verbose, ...) are read with neural_style.py's parser.
+'''
+def parse_args():
+  desc = 'Train and run a feed-forward style transfer network.'
+  parser = argparse.ArgumentParser(description=desc)
+
+  parser.add_argument('mode', type=str,
+    choices=['train', 'stylize'],
+    help='Train a network for one style, or stylize images with a trained one.')
+
+  parser.add_argument('--model_dir', type=str,
+    required=True,
+    help='Directory holding the trained network checkpoint and its config.')
+
+  # training
+  parser.add_argument('--train_dir', type=str,
+    help='Directory of content images to train on (example: a COCO image folder).')
+
+  parser.add_argument('--image_size', type=int,
+    default=256,
+    help='Training images are cropped to this square size. (default: %(default)s)')
+
+  parser.add_argument('--batch_size', type=int,
+    default=4,
+    help='Images per training step or inference batch. (default: %(default)s)')
+
+  parser.add_argument('--train_iterations', type=int,
+    default=40000,
+    help='Number of training steps. (default: %(default)s)')
+
+  parser.add_argument('--train_learning_rate', type=float,
+    default=1e-3,
+    help='Adam learning rate for the transformation network. (default: %(default)s)')
+
+  parser.add_argument('--width', type=int,
+    default=16,
+    help='Channels of the first transformation network layer; later layers use 2x and 4x. (default: %(default)s)')
+
+  parser.add_argument('--residual_blocks', type=int,
+    default=3,
+    help='Number of residual blocks in the transformation network. (default: %(default)s)')
+
+  parser.add_argument('--checkpoint_iterations', type=int,
+    default=1000,
+    help='Training steps between checkpoints. (default: %(default)s)')
+
+  # inference
+  parser.add_argument('--input_dir', type=str,
+    help='Directory of content images to stylize.')
+
+  parser.add_argument('--output_dir', type=str,
+    default='./image_output/fast',
+    help='Directory for stylized images. (default: %(default)s)')
+
+  fs_args, ns_argv = parser.parse_known_args()
+  if fs_args.mode == 'train' and fs_args.train_dir is None:
+    parser.error('train needs --train_dir')
+  if fs_args.mode == 'stylize' and fs_args.input_dir is None:
+    parser.error('stylize needs --input_dir')
+  # neural_style.py insists on a content image (and style for inference)
+  # even though they are unused here
+  ns_argv = ns_argv + ['--content_img', 'unused']
+  if fs_args.mode == 'stylize':
+    ns_argv = ns_argv + ['--style_imgs', 'unused']
+  return fs_args, ns_argv
+
+'''
+  image transformation network
+  remark: downsampling convs, residual blocks and nearest-neighbour
+  upsampling convs with instance normalization (Johnson et al. 2016),
+  narrowed by --width.
+'''
+def instance_norm(x):
+  channels = x.get_shape()[3].value
+  mean, var = tf.nn.moments(x, [1, 2], keep_dims=True)
+  scale = tf.get_variable('scale', [channels], initializer=tf.ones_initializer())
+  shift = tf.get_variable('shift', [channels], initializer=tf.zeros_initializer())
+  return scale * (x - mean) / tf.sqrt(var + 1e-5) + shift
+
+def conv_block(x, name, filters, size, stride, relu=True, norm=True):
+  with tf.variable_scope(name):
+    channels = x.get_shape()[3].value
+    W = tf.get_variable('W', [size, size, channels, filters])
+    x = tf.nn.conv2d(x, W, strides=[1, stride, stride, 1], padding='SAME')
+    if norm:
+      x = instance_norm(x)
+    else:
+      x += tf.get_variable('b', [filters], initializer=tf.zeros_initializer())
+    if relu:
+      x = tf.nn.relu(x)
+  return x
+
+def residual_block(x, name, filters):
+  with tf.variable_scope(name):
+    y = conv_block(x, 'conv1', filters, 3, 1)
+    y = conv_block(y, 'conv2', filters, 3, 1, relu=False)
+  return x + y
+
+def upsample_block(x, name, filters):
+  size = tf.shape(x)[1:3] * 2
+  x = tf.image.resize_nearest_neighbor(x, size)
+  return conv_block(x, name, filters, 3, 1)
+
+def transform_net(x, width, residual_blocks):
+  # input and output are preprocessed (mean subtracted rgb) images
+  shape = tf.shape(x)
+  with tf.variable_scope('transform', reuse=tf.AUTO_REUSE):
+    y = conv_block(x / 127.5, 'conv1', width, 9, 1)
+    y = conv_block(y, 'conv2', width * 2, 3, 2)
+    y = conv_block(y, 'conv3', width * 4, 3, 2)
+    for i in range(residual_blocks):
+      y = residual_block(y, 'residual{}'.format(i), width * 4)
+    y = upsample_block(y, 'up1', width * 2)
+    y = upsample_block(y, 'up2', width)
+    y = conv_block(y, 'output', 3, 9, 1, relu=False, norm=False)
+    y = tf.tanh(y) * 150.
+  # odd sizes come back one pixel larger after the strided convs
+  return y[:, :shape[1], :shape[2], :]
+
+'''
+  training
+'''
+def list_images(dir_path):
+  exts = ('.jpg', '.jpeg', '.png', '.bmp')
+  return sorted(os.path.join(dir_path, fn) for fn in os.listdir(dir_path)
+    if fn.lower().endswith(exts))
+
+def read_training_image(path, size):
+  # resize the shorter side to size, then take a random square crop
+  img = cv2.imread(path, cv2.IMREAD_COLOR)
+  ns.check_image(img, path)
+  h, w, _ = img.shape
+  scale = float(size) / min(h, w)
+  img = cv2.resize(img, dsize=(max(size, int(round(w * scale))),
+    max(size, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+  h, w, _ = img.shape
+  y = random.randint(0, h - size)
+  x = random.randint(0, w - size)
+  img = img[y:y+size, x:x+size].astype(np.float32)
+  return ns.preprocess(img)
+
+def get_style_grams(layer_table, params, weights_id, size):
+  # gram targets of the style image at the training size, via the gram cache
+  args = ns.args
+  style_fn = args.style_imgs[0]
+  path = os.path.join(args.style_imgs_dir, style_fn)
+  img = cv2.imread(path, cv2.IMREAD_COLOR)
+  ns.check_image(img, path)
+  img = cv2.resize(img.astype(np.float32), dsize=(size, size), interpolation=cv2.INTER_AREA)
+  img = ns.preprocess(img)
+  net = {'weights_id': weights_id}
+  grams, missing = ns.lookup_style_grams(net, img, style_fn)
+  if missing:
+    tower = ns.build_tower(tf.constant(img), layer_table, params, 'style/')
+    with tf.Session(config=ns.get_session_config()) as sess:
+      acts = sess.run([tower[layer] for layer in missing])
+    for layer, a in zip(missing, acts):
+      grams[layer] = ns.compute_gram(a)
+    ns.store_style_grams(net, img, style_fn, grams, missing)
+  return grams
+
+def build_training_graph(fs_args, style_grams, layer_table, params):
+  args = ns.args
+  size, batch = fs_args.image_size, fs_args.batch_size
+  content = tf.placeholder(tf.float32, shape=(batch, size, size, 3))
+  generated = transform_net(content, fs_args.width, fs_args.residual_blocks)
+  # the losses need static shapes
+  generated.set_shape(content.get_shape())
+  vgg_content = ns.build_tower(content, layer_table, params, 'content/')
+  vgg_generated = ns.build_tower(generated, layer_table, params, 'generated/')
+
+  L_content = 0.
+  for layer, weight in zip(args.content_layers, args.content_layer_weights):
+    L_content += ns.content_layer_loss(vgg_content[layer], vgg_generated[layer]) * weight
+  L_content /= float(len(args.content_layers) * batch)
+
+  # style_layer_loss works on one image at a time
+  L_style = 0.
+  for layer, weight in zip(args.style_layers, args.style_layer_weights):
+    A = tf.constant(style_grams[layer])
+    for i in range(batch):
+      L_style += ns.style_layer_loss(A, vgg_generated[layer][i:i+1]) * weight
+  L_style /= float(len(args.style_layers) * batch)
+
+  L_tv = tf.reduce_sum(tf.image.total_variation(generated)) / float(batch)
+
+  L_total  = args.content_weight * L_content
+  L_total += args.style_weight   * L_style
+  L_total += args.tv_weight      * L_tv
+
+  transform_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='transform')
+  train_op = tf.train.AdamOptimizer(fs_args.train_learning_rate).minimize(L_total,
+    var_list=transform_vars)
+  return content, L_total, train_op, transform_vars
+
+def train(fs_args):
+  args = ns.args
+  files = list_images(fs_args.train_dir)
+  if len(files) < fs_args.batch_size:
+    raise ValueError('{} has fewer images than --batch_size'.format(fs_args.train_dir))
+  random.seed(args.seed)
+  ns.maybe_make_directory(fs_args.model_dir)
+  config = {'style': args.style_imgs[0], 'width': fs_args.width,
+    'residual_blocks': fs_args.residual_blocks, 'image_size': fs_args.image_size,
+    'content_weight': args.content_weight, 'style_weight': args.style_weight,
+    'tv_weight': args.tv_weight, 'content_layers': args.content_layers,
+    'style_layers': args.style_layers, 'backbone': args.backbone}
+  with open(os.path.join(fs_args.model_dir, 'config.json'), 'w') as f:
+    json.dump(config, f, indent=2)
+
+  with tf.Graph().as_default(), tf.device(args.device):
+    layer_table, params, weights_id = ns.load_vgg_params()
+    style_grams = get_style_grams(layer_table, params, weights_id, fs_args.image_size)
+    content, loss, train_op, transform_vars = build_training_graph(fs_args,
+      style_grams, layer_table, params)
+    saver = tf.train.Saver(transform_vars)
+    with tf.Session(config=ns.get_session_config()) as sess:
+      sess.run(tf.global_variables_initializer())
+      checkpoint = tf.train.latest_checkpoint(fs_args.model_dir)
+      if checkpoint is not None:
+        if args.verbose: print('resuming from {}'.format(checkpoint))
+        saver.restore(sess, checkpoint)
+      tick = time.time()
+      for step in range(fs_args.train_iterations):
+        batch = np.concatenate([read_training_image(path, fs_args.image_size)
+          for path in random.sample(files, fs_args.batch_size)], axis=0)
+        _, curr_loss = sess.run([train_op, loss], feed_dict={content: batch})
+        if args.verbose and step % args.print_iterations == 0:
+          print('At step {}\tf=  {}\t{:.2f}s/step'.format(step, curr_loss,
+            (time.time() - tick) / (step + 1)))
+        if (step + 1) % fs_args.checkpoint_iterations == 0 or step + 1 == fs_args.train_iterations:
+          saver.save(sess, os.path.join(fs_args.model_dir, 'model.ckpt'), global_step=step + 1)
+
+'''
+  inference
+'''
+def stylize(fs_args):
+  args = ns.args
+  with open(os.path.join(fs_args.model_dir, 'config.json')) as f:
+    config = json.load(f)
+  ns.maybe_make_directory(fs_args.output_dir)
+  # images of the same shape are stylized together
+  by_shape = {}
+  for path in list_images(fs_args.input_dir):
+    img = ns.read_image(path)
+    by_shape.setdefault(img.shape, []).append((path, img))
+
+  with tf.Graph().as_default(), tf.device(args.device):
+    content = tf.placeholder(tf.float32, shape=(None, None, None, 3))
+    generated = transform_net(content, config['width'], config['residual_blocks'])
+    saver = tf.train.Saver(tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope='transform'))
+    with tf.Session(config=ns.get_session_config()) as sess:
+      saver.restore(sess, tf.train.latest_checkpoint(fs_args.model_dir))
+      n_images = 0
+      tick = time.time()
+      for shape, images in by_shape.items():
+        for start in range(0, len(images), fs_args.batch_size):
+          chunk = images[start:start + fs_args.batch_size]
+          batch = np.concatenate([img for _, img in chunk], axis=0)
+          outputs = sess.run(generated, feed_dict={content: batch})
+          for (path, _), output in zip(chunk, outputs):
+            out_path = os.path.join(fs_args.output_dir, os.path.basename(path))
+            ns.write_image(out_path, output[np.newaxis,:,:,:])
+          n_images += len(chunk)
+      tock = time.time()
+  print('Stylized {} images in {:.3f}s ({:.1f} ms/image)'.format(n_images,
+    tock - tick, 1000. * (tock - tick) / max(n_images, 1)))
+
+def main():
+  tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR) # quiet TF errors
+  fs_args, ns_argv = parse_args()
+  ns.args = ns.parse_args(ns_argv)
+  if fs_args.mode == 'train':
+    train(fs_args)
+  else:
+    stylize(fs_args)
+
+if __name__ == '__main__':
+  main()
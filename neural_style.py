@@ -1,16 +1,25 @@
 import tensorflow as tf
 import numpy as np 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import scipy.io  
 import argparse 
 import shutil
+import csv
+import sys
+import threading
+import concurrent.futures
+import contextlib
 import struct
 import errno
 import time                       
+import hashlib
+import json
 import cv2
 import os
 from pathlib import Path
 from memory_profiler import memory_usage
+from tensorflow.python.client import timeline
 
 # Modified from https://github.com/cysmith/neural-style-tf
 
@@ -21,7 +30,7 @@ from memory_profiler import memory_usage
 
   python3 neural_style.py --optimizer both --mem --verbose --style_imgs kandinsky.jpg --content_img hawaii.jpg --max_iterations 1000 --max_size 1024
 '''
-def parse_args():
+def parse_args(argv=None):
 
   desc = "TensorFlow implementation of 'A Neural Algorithm for Artistic Style'"  
   parser = argparse.ArgumentParser(description=desc)
@@ -34,8 +43,7 @@ def parse_args():
     help='Filename of the output image (auto-generated by default).')
 
   parser.add_argument('--style_imgs', nargs='+', type=str,
-    help='Filenames of the style images (example: starry-night.jpg)', 
-    required=True)
+    help='Filenames of the style images (example: starry-night.jpg)')
   
   parser.add_argument('--style_imgs_weights', nargs='+', type=float,
     default=[1.0],
@@ -48,6 +56,13 @@ def parse_args():
     default='./styles',
     help='Directory path to the style images. (default: %(default)s)')
 
+  parser.add_argument('--gram_cache_dir', type=str,
+    default='./gram_cache',
+    help='Directory of cached style Gram matrix targets. (default: %(default)s)')
+
+  parser.add_argument('--no_gram_cache', action='store_true',
+    help='Boolean flag indicating the style Gram targets should always be recomputed.')
+
   parser.add_argument('--content_img_dir', type=str,
     default='./image_input',
     help='Directory path to the content image. (default: %(default)s)')
@@ -70,11 +85,11 @@ def parse_args():
 
   parser.add_argument('--content_layers', nargs='+', type=str, 
     default=['conv4_2'],
-    help='VGG19 layers used for the content image. (default: %(default)s)')
+    help='Backbone layers used for the content image. (default: %(default)s)')
   
   parser.add_argument('--style_layers', nargs='+', type=str,
     default=['relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1'],
-    help='VGG19 layers used for the style image. (default: %(default)s)')
+    help='Backbone layers used for the style image. (default: %(default)s)')
   
   parser.add_argument('--content_layer_weights', nargs='+', type=float, 
     default=[1.0], 
@@ -88,14 +103,41 @@ def parse_args():
     default=0,
     help='Seed for the random number generator. (default: %(default)s)')
   
+  parser.add_argument('--backbone', type=str,
+    default='vgg19',
+    choices=sorted(BACKBONES.keys()),
+    help='Loss network. The *_pruned variants keep half the channels of every conv layer of their base network. (default: %(default)s)')
+
   parser.add_argument('--model_weights', type=str, 
-    default='imagenet-vgg-verydeep-19.mat',
-    help='Weights and biases of the VGG-19 network.')
+    help='Weights and biases of the backbone (MatConvNet .mat). "random" uses seeded random weights of the same shapes (for benchmarks). (default: the .mat of --backbone)')
+
+  parser.add_argument('--weights_cache_dir', type=str,
+    help='Directory of the memory-mapped weight cache converted from --model_weights. The directory belongs to the cache: it must be new, empty or an older cache, which is replaced when --model_weights changes. (default: <model_weights>_cache)')
   
   parser.add_argument('--device', type=str, 
     default='/cpu:0',
     choices=['/gpu:0', '/cpu:0'],
     help='GPU or CPU mode.  GPU mode requires NVIDIA CUDA. (default|recommended: %(default)s)')
+
+  parser.add_argument('--intra_op_threads', type=int,
+    default=0,
+    help='Threads used inside a single op (e.g. one conv2d). 0 lets TensorFlow pick. (default: %(default)s)')
+
+  parser.add_argument('--inter_op_threads', type=int,
+    default=0,
+    help='Threads used to run independent ops concurrently. 0 lets TensorFlow pick. (default: %(default)s)')
+
+  parser.add_argument('--precision', type=str,
+    default='float32',
+    choices=['float32', 'float16', 'bfloat16'],
+    help='Precision of the VGG weights and convolutions. The input image, gram matrices and losses stay float32. bfloat16 on CPU needs an MKL build or --xla. (default: %(default)s)')
+
+  parser.add_argument('--recompute_segments', nargs='+', type=str,
+    default=['none'],
+    help='Store the optimized tower\'s activations only at segment ends and recompute the rest in the backward pass: none, pool (a segment per pooling stage), sqrt (about sqrt(layers) segments) or the layer names that end segments. Trades time per iteration for peak memory. (default: %(default)s)')
+
+  parser.add_argument('--xla', action='store_true',
+    help='Boolean flag indicating the loss, its gradient and the Adam update should be compiled with XLA. Losses match the uncompiled graph to float32 rounding.')
   
   parser.add_argument('--img_output_dir', type=str, 
     default='./image_output',
@@ -106,6 +148,10 @@ def parse_args():
     default='lbfgs',
     choices=['lbfgs', 'adam', 'both'],
     help='Loss minimization optimizer.  L-BFGS gives better results.  Adam uses less memory. (default|recommended: %(default)s)')
+
+  parser.add_argument('--compare_configs', nargs='+', type=str,
+    default=['adam', 'lbfgs'],
+    help='Optimizer configs run by --optimizer both, as adam, lbfgs or e.g. adam:learning_rate=1,beta1=0.9 (options: learning_rate, beta1, beta2, epsilon, max_iterations, lbfgs_history). (default: %(default)s)')
   
   parser.add_argument('--learning_rate', type=float, 
     default=1e1, # original default 1e0
@@ -122,10 +168,60 @@ def parse_args():
   parser.add_argument('--epsilon', type=float, 
     default=1e-1, # original default 1e-8
     help='Numerical stability constant for the Adam optimizer. (default: %(default)s)')
+
+  parser.add_argument('--lbfgs_impl', type=str,
+    default='scipy',
+    choices=['scipy', 'graph'],
+    help='L-BFGS implementation: scipy uses L-BFGS-B through ScipyOptimizerInterface, graph (experimental) keeps its history in variables next to the image and never restarts between blocks, with a backtracking Armijo line search. (default|recommended: %(default)s)')
+
+  parser.add_argument('--lbfgs_history', type=int,
+    default=10,
+    help='Number of curvature pairs kept by the graph L-BFGS. (default: %(default)s)')
+
+  parser.add_argument('--lbfgs_line_search', type=str,
+    default='backtracking',
+    choices=['backtracking', 'none'],
+    help='Line search of the graph L-BFGS: backtracking until the Armijo condition holds, or always take the full step. (default: %(default)s)')
   
+  # output writing
+  parser.add_argument('--output_workers', type=int,
+    default=2,
+    help='Background threads that encode and write images and plots. 0 writes synchronously. (default: %(default)s)')
+
+  parser.add_argument('--output_queue', type=int,
+    default=8,
+    help='Maximum pending background writes before the optimizer waits. (default: %(default)s)')
+
+  # early stopping
+  parser.add_argument('--stop_window', type=int,
+    default=0,
+    help='Stop when the loss improved by less than --stop_rel_tol over this many iterations. 0 disables. (default: %(default)s)')
+
+  parser.add_argument('--stop_rel_tol', type=float,
+    default=1e-3,
+    help='Relative loss improvement over --stop_window iterations below which optimization stops. (default: %(default)s)')
+
+  parser.add_argument('--stop_loss', type=float,
+    help='Stop as soon as the loss reaches this value.')
+
+  parser.add_argument('--time_budget', type=float,
+    help='Stop optimizing after this many seconds.')
+
+  parser.add_argument('--separate_loss_eval', action='store_true',
+    help='Boolean flag indicating Adam should evaluate the loss in a second forward pass after each update instead of fetching it with the update.')
+
+  # checkpoints
+  parser.add_argument('--checkpoint_every', type=int,
+    default=0,
+    help='Save the image, optimizer state and loss history to checkpoint.npz in the output directory every this many iterations. 0 disables. (default: %(default)s)')
+
+  parser.add_argument('--resume', action='store_true',
+    help='Boolean flag indicating a run should continue from its checkpoint.npz if one exists.')
+
   parser.add_argument('--blocks', type=int, 
     default=1,
-    # note: interupting BFGS training into blocks to save output makes it go slower
+    # note: interupting scipy BFGS training into blocks to save output makes it go slower;
+    # the graph L-BFGS keeps its history across blocks
     help='Number of times to save intermediary L-BFGS image output. (default: %(default)s)')
  
   parser.add_argument('--max_iterations', type=int, 
@@ -140,131 +236,719 @@ def parse_args():
     help='Boolean flag indicating whether to save intermediary output images')
 
   parser.add_argument('--mem', action='store_true',
-    help='Boolean flag indicating whether to profile memory usage')
+    help='Boolean flag indicating whether to profile memory usage. With --optimizer both, the configs share one graph and process, so each config is measured with the state of the configs run before it still resident.')
 
-  args = parser.parse_args()
+  parser.add_argument('--mem_interval', type=float,
+    default=1.,
+    help='Seconds between memory samples with --mem. (default: %(default)s)')
 
-  # normalize weights
-  args.style_layer_weights   = normalize(args.style_layer_weights)
-  args.content_layer_weights = normalize(args.content_layer_weights)
-  args.style_imgs_weights    = normalize(args.style_imgs_weights)
+  # instrumentation
+  parser.add_argument('--log_jsonl', type=str,
+    help='Append per-iteration loss, time and rss records and per-job phase timings to this JSONL file.')
 
-  # create directories for output
-  maybe_make_directory(args.img_output_dir)
+  parser.add_argument('--trace_iterations', nargs='+', type=int,
+    default=[],
+    help='Iterations to run with full TensorFlow tracing; each writes a Chrome trace and a per-layer cost summary.')
 
-  return args
+  parser.add_argument('--trace_dir', type=str,
+    help='Directory for the Chrome traces of --trace_iterations. (default: the output image directory)')
 
-'''
-  pre-trained vgg19 convolutional neural network
-  remark: layers are manually initialized for clarity.
-'''
+  # coarse-to-fine optimization
+  parser.add_argument('--pyramid_levels', type=int,
+    default=1,
+    help='Number of scales to optimize at, each twice the size of the last and ending at --max_size. (default: %(default)s)')
 
-def build_model(input_img):
-  if args.verbose: print('\nBUILDING VGG-19 NETWORK')
-  net = {}
-  _, h, w, d     = input_img.shape
-  
-  if args.verbose: print('loading model weights...')
-  vgg_rawnet     = scipy.io.loadmat(args.model_weights)
-  vgg_layers     = vgg_rawnet['layers'][0]
-  if args.verbose: print('constructing layers...')
-  net['input']   = tf.Variable(np.zeros((1, h, w, d), dtype=np.float32))
+  parser.add_argument('--pyramid_iterations', nargs='+', type=int,
+    help='Max iterations per block at each pyramid level, coarsest first. (default: --max_iterations at every level)')
 
-  if args.verbose: print('LAYER GROUP 1')
-  net['conv1_1'] = conv_layer('conv1_1', net['input'], W=get_weights(vgg_layers, 0))
-  net['relu1_1'] = relu_layer('relu1_1', net['conv1_1'], b=get_bias(vgg_layers, 0))
+  # tiled rendering
+  parser.add_argument('--tile_size', type=int,
+    default=0,
+    help='Stylize the image in overlapping square tiles of this size so memory depends on the tile, not the output size. 0 disables tiling. (default: %(default)s)')
 
-  net['conv1_2'] = conv_layer('conv1_2', net['relu1_1'], W=get_weights(vgg_layers, 2))
-  net['relu1_2'] = relu_layer('relu1_2', net['conv1_2'], b=get_bias(vgg_layers, 2))
-  
-  net['pool1']   = pool_layer('pool1', net['relu1_2'])
+  parser.add_argument('--tile_overlap', type=int,
+    default=64,
+    help='Overlap in pixels between neighbouring tiles, blended linearly. (default: %(default)s)')
 
-  if args.verbose: print('LAYER GROUP 2')  
-  net['conv2_1'] = conv_layer('conv2_1', net['pool1'], W=get_weights(vgg_layers, 5))
-  net['relu2_1'] = relu_layer('relu2_1', net['conv2_1'], b=get_bias(vgg_layers, 5))
-  
-  net['conv2_2'] = conv_layer('conv2_2', net['relu2_1'], W=get_weights(vgg_layers, 7))
-  net['relu2_2'] = relu_layer('relu2_2', net['conv2_2'], b=get_bias(vgg_layers, 7))
-  
-  net['pool2']   = pool_layer('pool2', net['relu2_2'])
-  
-  if args.verbose: print('LAYER GROUP 3')
-  net['conv3_1'] = conv_layer('conv3_1', net['pool2'], W=get_weights(vgg_layers, 10))
-  net['relu3_1'] = relu_layer('relu3_1', net['conv3_1'], b=get_bias(vgg_layers, 10))
+  parser.add_argument('--tile_workers', type=int,
+    default=1,
+    help='Number of tiles stylized at the same time, each with its own session. (default: %(default)s)')
+
+  # subsampled style loss
+  parser.add_argument('--style_sample_rates', nargs='+', type=float,
+    help='Fraction of spatial positions used to estimate each style layer gram matrix, one value per style layer or one for all. Best with Adam; the estimate is resampled every iteration. (default: exact gram matrices)')
+
+  parser.add_argument('--style_sample_mode', type=str,
+    default='random',
+    choices=['random', 'strided'],
+    help='How spatial positions are subsampled for --style_sample_rates. (default: %(default)s)')
+
+  # frame sequences
+  parser.add_argument('--video_input', type=str,
+    help='Directory of frames (sorted by name) or a video file to stylize frame by frame.')
+
+  parser.add_argument('--first_frame_iterations', type=int,
+    help='Max iterations per block for the first frame. (default: --max_iterations)')
 
-  net['conv3_2'] = conv_layer('conv3_2', net['relu3_1'], W=get_weights(vgg_layers, 12))
-  net['relu3_2'] = relu_layer('relu3_2', net['conv3_2'], b=get_bias(vgg_layers, 12))
+  parser.add_argument('--frame_iterations', type=int,
+    default=100,
+    help='Max iterations per block for every later frame, warm started from the previous output. (default: %(default)s)')
 
-  net['conv3_3'] = conv_layer('conv3_3', net['relu3_2'], W=get_weights(vgg_layers, 14))
-  net['relu3_3'] = relu_layer('relu3_3', net['conv3_3'], b=get_bias(vgg_layers, 14))
+  parser.add_argument('--video_fps', type=float,
+    default=0.,
+    help='Also write the stylized frames to output.avi at this frame rate. 0 only writes frames. (default: %(default)s)')
 
-  net['conv3_4'] = conv_layer('conv3_4', net['relu3_3'], W=get_weights(vgg_layers, 16))
-  net['relu3_4'] = relu_layer('relu3_4', net['conv3_4'], b=get_bias(vgg_layers, 16))
+  # batch jobs
+  parser.add_argument('--batch', type=str,
+    help='JSON or CSV manifest of jobs to render in one process. Keys/columns are option names (example: content_img, style_imgs, max_size). Other command line options are the defaults for every job.')
 
-  net['pool3']   = pool_layer('pool3', net['relu3_4'])
+  args = parser.parse_args(argv)
 
-  if args.verbose: print('LAYER GROUP 4')
-  net['conv4_1'] = conv_layer('conv4_1', net['pool3'], W=get_weights(vgg_layers, 19))
-  net['relu4_1'] = relu_layer('relu4_1', net['conv4_1'], b=get_bias(vgg_layers, 19))
+  if args.pyramid_iterations is not None and len(args.pyramid_iterations) != args.pyramid_levels:
+    parser.error('--pyramid_iterations needs one value per pyramid level')
 
-  net['conv4_2'] = conv_layer('conv4_2', net['relu4_1'], W=get_weights(vgg_layers, 21))
-  net['relu4_2'] = relu_layer('relu4_2', net['conv4_2'], b=get_bias(vgg_layers, 21))
+  if args.style_sample_rates is not None:
+    if len(args.style_sample_rates) not in (1, len(args.style_layers)):
+      parser.error('--style_sample_rates needs one value or one per style layer')
+    if any(rate <= 0. or rate > 1. for rate in args.style_sample_rates):
+      parser.error('--style_sample_rates must be in (0, 1]')
 
-  net['conv4_3'] = conv_layer('conv4_3', net['relu4_2'], W=get_weights(vgg_layers, 23))
-  net['relu4_3'] = relu_layer('relu4_3', net['conv4_3'], b=get_bias(vgg_layers, 23))
+  if args.lbfgs_history < 1:
+    parser.error('--lbfgs_history must be at least 1')
 
-  net['conv4_4'] = conv_layer('conv4_4', net['relu4_3'], W=get_weights(vgg_layers, 25))
-  net['relu4_4'] = relu_layer('relu4_4', net['conv4_4'], b=get_bias(vgg_layers, 25))
+  if args.output_queue < 1:
+    parser.error('--output_queue must be at least 1')
 
-  net['pool4']   = pool_layer('pool4', net['relu4_4'])
+  if args.tile_size > 0 and args.pyramid_levels > 1:
+    parser.error('--tile_size and --pyramid_levels cannot be combined')
 
-  if args.verbose: print('LAYER GROUP 5')
-  net['conv5_1'] = conv_layer('conv5_1', net['pool4'], W=get_weights(vgg_layers, 28))
-  net['relu5_1'] = relu_layer('relu5_1', net['conv5_1'], b=get_bias(vgg_layers, 28))
+  if args.tile_size > 0 and args.tile_overlap * 2 >= args.tile_size:
+    parser.error('--tile_overlap must be less than half of --tile_size')
 
-  net['conv5_2'] = conv_layer('conv5_2', net['relu5_1'], W=get_weights(vgg_layers, 30))
-  net['relu5_2'] = relu_layer('relu5_2', net['conv5_2'], b=get_bias(vgg_layers, 30))
+  if (args.checkpoint_every > 0 or args.resume) and (args.video_input is not None
+      or args.tile_size > 0 or args.pyramid_levels > 1):
+    parser.error('--checkpoint_every and --resume only support single image renders')
 
-  net['conv5_3'] = conv_layer('conv5_3', net['relu5_2'], W=get_weights(vgg_layers, 32))
-  net['relu5_3'] = relu_layer('relu5_3', net['conv5_3'], b=get_bias(vgg_layers, 32))
+  if args.model_weights is None:
+    args.model_weights = BACKBONES[args.backbone]['weights']
 
-  net['conv5_4'] = conv_layer('conv5_4', net['relu5_3'], W=get_weights(vgg_layers, 34))
-  net['relu5_4'] = relu_layer('relu5_4', net['conv5_4'], b=get_bias(vgg_layers, 34))
+  try:
+    args.compare_configs = [parse_compare_config(spec) for spec in args.compare_configs]
+  except ValueError as e:
+    parser.error(str(e))
 
-  net['pool5']   = pool_layer('pool5', net['relu5_4'])
+  layer_names = [name for name, _ in BACKBONES[args.backbone]['layers']]
+  unknown = [layer for layer in args.content_layers + args.style_layers if layer not in layer_names]
+  if unknown:
+    parser.error('{} has no layers {}'.format(args.backbone, ' '.join(unknown)))
 
+  if args.recompute_segments not in (['none'], ['pool'], ['sqrt']):
+    unknown = [layer for layer in args.recompute_segments if layer not in layer_names]
+    if unknown:
+      parser.error('--recompute_segments: {} has no layers {}'.format(args.backbone, ' '.join(unknown)))
+
+  if args.video_input is not None and args.content_img is None:
+    # output directories are named after the content image
+    args.content_img = os.path.basename(os.path.normpath(args.video_input)) + '.vid'
+
+  if args.batch is None and (args.style_imgs is None or args.content_img is None):
+    parser.error('--style_imgs and --content_img are required unless --batch is given')
+
+  # normalize weights
+  args.style_layer_weights   = normalize(args.style_layer_weights)
+  args.content_layer_weights = normalize(args.content_layer_weights)
+  args.style_imgs_weights    = normalize(args.style_imgs_weights)
+
+  # create directories for output
+  maybe_make_directory(args.img_output_dir)
+
+  return args
+
+'''
+  instrumentation
+  remark: phase times are exclusive, so weight loading inside a graph build
+  is only counted as weight loading.  tile workers add their phases from
+  several threads, so a tiled job can sum to more than its wall time.
+'''
+phase_times = {}
+phase_lock = threading.Lock()
+phase_state = threading.local()
+
+@contextlib.contextmanager
+def timed_phase(name):
+  stack = getattr(phase_state, 'stack', None)
+  if stack is None:
+    stack = phase_state.stack = []
+  now = time.time()
+  if stack:
+    # pause the enclosing phase
+    add_phase_time(stack[-1][0], now - stack[-1][1])
+  stack.append([name, now])
+  try:
+    yield
+  finally:
+    now = time.time()
+    add_phase_time(name, now - stack.pop()[1])
+    if stack:
+      stack[-1][1] = now
+
+def add_phase_time(name, seconds):
+  with phase_lock:
+    phase_times[name] = phase_times.get(name, 0.) + seconds
+
+def reset_phase_times():
+  with phase_lock:
+    phase_times.clear()
+
+def report_phase_times(optimizer):
+  total = sum(phase_times.values())
+  if args.verbose:
+    print('\nPHASE TIMES')
+    for name, seconds in sorted(phase_times.items(), key=lambda item: -item[1]):
+      print('{:<20} {:>9.3f}s {:>6.1%}'.format(name, seconds, seconds / max(total, 1e-9)))
+  log_record({'event': 'phases', 'content_img': args.content_img,
+    'style_imgs': args.style_imgs, 'optimizer': optimizer,
+    'max_size': args.max_size, 'phases': dict(phase_times)})
+  flush_log()
+
+def get_rss_mib():
+  # current (not peak) resident set size, cheap enough to read every iteration
+  try:
+    with open('/proc/self/statm') as f:
+      pages = int(f.read().split()[1])
+  except (IOError, OSError):
+    return None
+  return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.
+
+iteration_log = None
+iteration_log_lock = threading.Lock()
+
+# callables that also receive every record (e.g. progress for server.py)
+record_listeners = []
+
+def is_logging():
+  return args.log_jsonl is not None or len(record_listeners) > 0
+
+def log_record(record):
+  global iteration_log
+  for listener in record_listeners:
+    listener(record)
+  if args.log_jsonl is None:
+    return
+  with iteration_log_lock:
+    if iteration_log is None or iteration_log.name != args.log_jsonl:
+      if iteration_log is not None:
+        iteration_log.close()
+      iteration_log = open(args.log_jsonl, 'a')
+    iteration_log.write(json.dumps(record) + '\n')
+
+def log_iterations(start, losses, times, rss=None):
+  for i in range(len(losses)):
+    mib = None if rss is None else rss[i]
+    log_record({'event': 'iteration', 'optimizer': args.optimizer,
+      'iteration': start + i, 'loss': float(losses[i]), 'time': float(times[i]),
+      'rss_mib': None if mib is None or np.isnan(mib) else float(mib)})
+
+def flush_log():
+  with iteration_log_lock:
+    if iteration_log is not None:
+      iteration_log.flush()
+
+def close_log():
+  global iteration_log
+  with iteration_log_lock:
+    if iteration_log is not None:
+      iteration_log.close()
+      iteration_log = None
+
+def run_traced(sess, fetches, iteration):
+  # one fully traced run: chrome trace plus op time summed per layer scope
+  options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+  run_metadata = tf.RunMetadata()
+  tick = time.time()
+  result = sess.run(fetches, options=options, run_metadata=run_metadata)
+  run_time = time.time() - tick
+  trace_dir = args.trace_dir
+  if trace_dir is None:
+    trace_dir, _ = get_image_savename(args.blocks, 0)
+  maybe_make_directory(trace_dir)
+  path = os.path.join(trace_dir, 'trace_{}_{}.json'.format(args.optimizer, iteration))
+  trace = timeline.Timeline(run_metadata.step_stats)
+  with open(path, 'w') as f:
+    f.write(trace.generate_chrome_trace_format())
+  costs = get_scope_costs(run_metadata.step_stats)
+  if args.verbose:
+    print('traced iteration {} in {:.1f}ms -> {}'.format(iteration, 1000. * run_time, path))
+    for scope, ms in sorted(costs.items(), key=lambda item: -item[1])[:10]:
+      print('  {:<24} {:>9.2f}ms'.format(scope, ms))
+  log_record({'event': 'trace', 'optimizer': args.optimizer, 'iteration': iteration,
+    'run_time': run_time, 'path': path, 'scope_ms': costs})
+  return result
+
+def get_scope_costs(step_stats):
+  # ops are grouped by their top name scope (conv3_1, style_relu3_1, Adam, ...);
+  # backward ops are grouped as <scope>_grad.  on gpu the stream stats are
+  # listed next to the device stats, so kernels are counted twice there.
+  costs = {}
+  for dev_stats in step_stats.dev_stats:
+    for node in dev_stats.node_stats:
+      parts = node.node_name.split(':')[0].split('/')
+      if parts[0] == 'gradients' and len(parts) > 1:
+        scope = parts[1] + '_grad'
+      else:
+        scope = parts[0]
+      costs[scope] = costs.get(scope, 0.) + node.all_end_rel_micros / 1000.
+  return costs
+
+'''
+  pre-trained loss network backbones
+  remark: layers are listed in order as (name, index into the .mat layers)
+  so the network can be cut off after the deepest layer a loss uses.
+  pruned backbones load the weights of their base network and keep the
+  output channels with the largest filter l1 norms in every conv layer,
+  along with the matching input channels of the next conv layer.
+'''
+VGG19_LAYERS = (
+  ('conv1_1', 0),  ('relu1_1', 0),  ('conv1_2', 2),  ('relu1_2', 2),
+  ('pool1', None),
+  ('conv2_1', 5),  ('relu2_1', 5),  ('conv2_2', 7),  ('relu2_2', 7),
+  ('pool2', None),
+  ('conv3_1', 10), ('relu3_1', 10), ('conv3_2', 12), ('relu3_2', 12),
+  ('conv3_3', 14), ('relu3_3', 14), ('conv3_4', 16), ('relu3_4', 16),
+  ('pool3', None),
+  ('conv4_1', 19), ('relu4_1', 19), ('conv4_2', 21), ('relu4_2', 21),
+  ('conv4_3', 23), ('relu4_3', 23), ('conv4_4', 25), ('relu4_4', 25),
+  ('pool4', None),
+  ('conv5_1', 28), ('relu5_1', 28), ('conv5_2', 30), ('relu5_2', 30),
+  ('conv5_3', 32), ('relu5_3', 32), ('conv5_4', 34), ('relu5_4', 34),
+  ('pool5', None))
+
+VGG16_LAYERS = (
+  ('conv1_1', 0),  ('relu1_1', 0),  ('conv1_2', 2),  ('relu1_2', 2),
+  ('pool1', None),
+  ('conv2_1', 5),  ('relu2_1', 5),  ('conv2_2', 7),  ('relu2_2', 7),
+  ('pool2', None),
+  ('conv3_1', 10), ('relu3_1', 10), ('conv3_2', 12), ('relu3_2', 12),
+  ('conv3_3', 14), ('relu3_3', 14),
+  ('pool3', None),
+  ('conv4_1', 17), ('relu4_1', 17), ('conv4_2', 19), ('relu4_2', 19),
+  ('conv4_3', 21), ('relu4_3', 21),
+  ('pool4', None),
+  ('conv5_1', 24), ('relu5_1', 24), ('conv5_2', 26), ('relu5_2', 26),
+  ('conv5_3', 28), ('relu5_3', 28),
+  ('pool5', None))
+
+BACKBONES = {
+  'vgg19': {'layers': VGG19_LAYERS, 'weights': 'imagenet-vgg-verydeep-19.mat'},
+  'vgg16': {'layers': VGG16_LAYERS, 'weights': 'imagenet-vgg-verydeep-16.mat'},
+  'vgg19_pruned': {'layers': VGG19_LAYERS, 'weights': 'imagenet-vgg-verydeep-19.mat',
+    'keep_channels': 0.5},
+  'vgg16_pruned': {'layers': VGG16_LAYERS, 'weights': 'imagenet-vgg-verydeep-16.mat',
+    'keep_channels': 0.5}}
+
+def get_required_layers(layer_table):
+  names = [name for name, _ in layer_table]
+  used = list(args.content_layers) + list(args.style_layers)
+  for layer in used:
+    if layer not in names:
+      raise ValueError('Unknown {} layer: {}'.format(args.backbone, layer))
+  deepest = max(names.index(layer) for layer in used)
+  return layer_table[:deepest + 1]
+
+def build_model(input_img):
+  if args.verbose: print('\nBUILDING {} NETWORK'.format(args.backbone.upper()))
+  net = {}
+  _, h, w, d     = input_img.shape
+  
+  layer_table, params, net['weights_id'] = load_vgg_params()
+  if args.verbose: print('constructing layers...')
+  net.update(build_input_net(input_img.shape, layer_table, params))
+  # kept so more inputs can be built on the same weight constants
+  net['layer_table'], net['params'] = layer_table, params
+  if args.precision != 'float32':
+    net['precision_info'] = get_precision_info(params, layer_table, net)
+  if args.recompute_segments != ['none']:
+    net['recompute_info'] = get_recompute_info(layer_table, net)
+
+  # a second tower on a fed batch extracts every target in one forward pass
+  net['targets_input'] = tf.placeholder(tf.float32, shape=(None, h, w, d))
+  net['targets'] = build_tower(net['targets_input'], layer_table, params, 'targets/')
+
+  return net
+
+def build_input_net(shape, layer_table, params):
+  # the optimized image and the tower computed on it
+  net = {'input': tf.Variable(np.zeros(shape, dtype=np.float32))}
+  with get_jit_scope():
+    net.update(build_tower(net['input'], layer_table, params,
+      segment_ends=get_segment_ends(layer_table)))
   return net
 
-def conv_layer(layer_name, layer_input, W):
+@timed_phase('weight_load')
+def load_vgg_params():
+  # weight constants are shared by every tower built on them
+  if args.verbose: print('loading model weights...')
+  backbone = BACKBONES[args.backbone]
+  vgg_layers = load_vgg_layers(args.model_weights)
+  layer_table = get_required_layers(backbone['layers'])
+  params = {}
+  in_keep = None
+  for name, i in layer_table:
+    if name.startswith('conv'):
+      out_keep = None
+      if 'keep_channels' in backbone:
+        out_keep = get_pruned_channels(vgg_layers, i, backbone['keep_channels'])
+      params[i] = (get_weights(vgg_layers, i, in_keep, out_keep),
+        get_bias(vgg_layers, i, out_keep))
+      in_keep = out_keep
+  weights_id = get_weights_id(vgg_layers)
+  if args.backbone != 'vgg19':
+    # pruned targets differ from the full network's on the same weights
+    weights_id += '-' + args.backbone
+  if args.precision != 'float32':
+    # reduced precision targets are cached apart from the float32 ones
+    weights_id += '-' + args.precision
+  return layer_table, params, weights_id
+
+def build_tower(x, layer_table, params, prefix='', segment_ends=None):
+  # layers run in --precision, their outputs are handed out as float32 so
+  # gram matrices and losses accumulate in full precision
+  dtype = get_compute_dtype()
+  x = tf.cast(x, dtype)
+  if segment_ends:
+    return build_recomputed_tower(x, layer_table, params, segment_ends)
+  tower = {}
+  build_layers(x, layer_table, params, tower, prefix)
+  return tower
+
+def build_layers(x, layer_table, params, tower, prefix='', verbose=True):
+  # verbose=False builds quietly even with --verbose (recomputed segments)
+  verbose = verbose and args.verbose
+  for name, i in layer_table:
+    # one name scope per layer so traced op costs can be grouped by layer
+    with tf.name_scope(prefix + name):
+      if name.startswith('conv'):
+        if verbose and name.endswith('_1'):
+          print('LAYER GROUP {}'.format(name[4]))
+        x = conv_layer(prefix + name, x, W=params[i][0], verbose=verbose)
+      elif name.startswith('relu'):
+        x = relu_layer(prefix + name, x, b=params[i][1], verbose=verbose)
+      else:
+        x = pool_layer(prefix + name, x, verbose=verbose)
+    tower[name] = tf.cast(x, tf.float32)
+  return x
+
+'''
+  activation recomputation
+  remark: the optimized tower is split into segments after the
+  --recompute_segments layers.  a segment is one custom gradient, so only
+  its input and the layers the losses read stay alive after the forward
+  pass; the backward pass rebuilds the segment's activations from its
+  input once the gradient arrives.  the target tower is never
+  differentiated and is built as usual.
+'''
+def get_segment_ends(layer_table):
+  names = [name for name, _ in layer_table]
+  if args.recompute_segments == ['none']:
+    return []
+  if args.recompute_segments == ['pool']:
+    return [name for name in names if name.startswith('pool')]
+  if args.recompute_segments == ['sqrt']:
+    size = max(1, int(round(np.sqrt(len(names)))))
+    return names[size-1::size]
+  return [name for name in names if name in args.recompute_segments]
+
+def get_segments(layer_table, segment_ends):
+  segments = [[]]
+  for name, i in layer_table:
+    segments[-1].append((name, i))
+    if name in segment_ends:
+      segments.append([])
+  return [segment for segment in segments if segment]
+
+def build_recomputed_tower(x, layer_table, params, segment_ends):
+  loss_layers = set(args.content_layers) | set(args.style_layers)
+  tower = {}
+  for segment in get_segments(layer_table, segment_ends):
+    taps = [name for name, _ in segment if name in loss_layers]
+    outputs = build_segment(x, segment, params, taps, tower)
+    x = outputs[0]
+    # the losses read the segment outputs, so their gradients go through
+    # the recomputation instead of the forward pass's activations
+    tower.update(zip(taps, outputs[1:]))
+  return tower
+
+def build_segment(x, segment, params, taps, tower):
+  @tf.custom_gradient
+  def segment_fn(x_in):
+    # layers outside taps are only in tower for their shapes
+    activations = {}
+    y = build_layers(x_in, segment, params, activations)
+    tower.update(activations)
+    outputs = [y] + [activations[name] for name in taps]
+    def grad(*dys):
+      # waiting for the gradient keeps the recomputation out of the forward pass
+      with tf.control_dependencies([dy for dy in dys if dy is not None]):
+        x_re = tf.identity(x_in)
+      recomputed = {}
+      y_re = build_layers(x_re, segment, params, recomputed, verbose=False)
+      outputs_re = [y_re] + [recomputed[name] for name in taps]
+      dys = [tf.zeros_like(out) if dy is None else dy for out, dy in zip(outputs_re, dys)]
+      return tf.gradients(outputs_re, x_re, grad_ys=dys)[0]
+    return outputs, grad
+  return segment_fn(x)
+
+def get_recompute_info(layer_table, net):
+  # static sizes of the activations kept for the backward pass: segment
+  # inputs and loss layers, plus the largest segment while it is rebuilt
+  mib = get_compute_dtype().size / 1048576.
+  segment_ends = get_segment_ends(layer_table)
+  loss_layers = set(args.content_layers) | set(args.style_layers)
+  size = dict((name, net[name].get_shape().num_elements()) for name, _ in layer_table)
+  stored = sum(size[name] for name in size if name in segment_ends or name in loss_layers)
+  largest = max(sum(size[name] for name, _ in segment)
+    for segment in get_segments(layer_table, segment_ends))
+  info = {'recompute_segments': ' '.join(segment_ends),
+    'recompute_stored_mib': stored * mib, 'recompute_segment_mib': largest * mib,
+    'recompute_full_mib': sum(size.values()) * mib}
+  if args.verbose:
+    print('recompute: {} segments, activations {:.1f} MiB stored + {:.1f} MiB rebuilt (no recompute {:.1f} MiB)'.format(
+      len(segment_ends) + 1, info['recompute_stored_mib'], info['recompute_segment_mib'],
+      info['recompute_full_mib']))
+  return info
+
+def get_compute_dtype():
+  return tf.as_dtype(args.precision)
+
+def get_precision_info(params, layer_table, net):
+  # static sizes of the weights and the activations kept for the backward
+  # pass, against the same network in float32
+  mib = get_compute_dtype().size / 1048576.
+  weights = sum(W.get_shape().num_elements() + b.get_shape().num_elements()
+    for W, b in params.values())
+  activations = sum(net[name].get_shape().num_elements() for name, _ in layer_table)
+  info = {'precision': args.precision,
+    'weights_mib': weights * mib, 'weights_mib_float32': weights * 4 / 1048576.,
+    'activations_mib': activations * mib, 'activations_mib_float32': activations * 4 / 1048576.}
+  if args.verbose:
+    print('{}: weights {:.1f} MiB (float32 {:.1f} MiB), activations {:.1f} MiB (float32 {:.1f} MiB)'.format(
+      args.precision, info['weights_mib'], info['weights_mib_float32'],
+      info['activations_mib'], info['activations_mib_float32']))
+  return info
+
+def conv_layer(layer_name, layer_input, W, verbose=True):
   conv = tf.nn.conv2d(layer_input, W, strides=[1, 1, 1, 1], padding='SAME')
-  if args.verbose: print('--{} | shape={} | weights_shape={}'.format(layer_name, 
+  if verbose and args.verbose: print('--{} | shape={} | weights_shape={}'.format(layer_name, 
     conv.get_shape(), W.get_shape()))
   return conv
 
-def relu_layer(layer_name, layer_input, b):
+def relu_layer(layer_name, layer_input, b, verbose=True):
   relu = tf.nn.relu(layer_input + b)
-  if args.verbose: 
+  if verbose and args.verbose: 
     print('--{} | shape={} | bias_shape={}'.format(layer_name, relu.get_shape(), 
       b.get_shape()))
   return relu
 
-def pool_layer(layer_name, layer_input):
+def pool_layer(layer_name, layer_input, verbose=True):
   pool = tf.nn.avg_pool(layer_input, ksize=[1, 2, 2, 1], # could also do a max pool
     strides=[1, 2, 2, 1], padding='SAME')
-  if args.verbose: 
+  if verbose and args.verbose: 
     print('--{}   | shape={}'.format(layer_name, pool.get_shape()))
   return pool
 
-def get_weights(vgg_layers, i):
-  weights = vgg_layers[i][0][0][2][0][0]
-  W = tf.constant(weights)
+def get_weights(vgg_layers, i, in_keep=None, out_keep=None):
+  weights = get_cached_array(vgg_layers, i, 'weights')
+  if in_keep is not None:
+    weights = weights[:, :, in_keep, :]
+  if out_keep is not None:
+    weights = weights[:, :, :, out_keep]
+  W = tf.constant(weights.astype(get_compute_dtype().as_numpy_dtype, copy=False))
   return W
 
-def get_bias(vgg_layers, i):
-  bias = vgg_layers[i][0][0][2][0][1]
+def get_bias(vgg_layers, i, out_keep=None):
+  bias = get_cached_array(vgg_layers, i, 'bias')
+  if out_keep is not None:
+    bias = bias[out_keep]
+  bias = bias.astype(get_compute_dtype().as_numpy_dtype, copy=False)
   b = tf.constant(np.reshape(bias, (bias.size)))
   return b
 
+def get_pruned_channels(vgg_layers, i, fraction):
+  # output channels with the largest filter l1 norms, in network order
+  weights = get_cached_array(vgg_layers, i, 'weights')
+  norms = np.sum(np.abs(weights), axis=(0, 1, 2))
+  keep = max(1, int(round(norms.size * fraction)))
+  return np.sort(np.argsort(-norms)[:keep])
+
+'''
+  memory-mapped weight cache
+  remark: the .mat file is converted once into one .npy file per backbone conv layer
+  plus a manifest, so later runs only map the layers they actually use.
+'''
+# memory maps shared by every render in this process
+mapped_arrays = {}
+
+def get_weights_cache_dir(model_weights):
+  if args.weights_cache_dir is not None:
+    return args.weights_cache_dir
+  return os.path.splitext(model_weights)[0] + '_cache'
+
+def file_sha1(path):
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      sha1.update(chunk)
+  return sha1.hexdigest()
+
+def convert_weights(model_weights, cache_dir):
+  check_cache_dir(cache_dir)
+  if args.verbose: print('converting {} to weight cache {}...'.format(model_weights, cache_dir))
+  vgg_rawnet = scipy.io.loadmat(model_weights)
+  vgg_layers = vgg_rawnet['layers'][0]
+  # one temporary directory per process, so concurrent conversions
+  # (e.g. scheduler or server workers on a cold start) never share one
+  tmp_dir = '{}.{}.tmp'.format(cache_dir, os.getpid())
+  if os.path.exists(tmp_dir):
+    shutil.rmtree(tmp_dir)
+  maybe_make_directory(tmp_dir)
+  # only the conv layers of a backbone table; matconvnet also stores the
+  # fully connected layers as conv layers, and fc6 alone is 7x7x512x4096
+  wanted = set((name, i) for backbone in BACKBONES.values()
+    for name, i in backbone['layers'] if name.startswith('conv'))
+  layers = {}
+  for i in range(len(vgg_layers)):
+    layer = vgg_layers[i][0][0]
+    if (str(layer['name'][0]), i) not in wanted:
+      continue
+    weights = np.ascontiguousarray(layer['weights'][0][0], dtype=np.float32)
+    bias = np.ascontiguousarray(layer['weights'][0][1], dtype=np.float32)
+    bias = np.reshape(bias, (bias.size))
+    # .npy headers are padded so the data starts on an aligned offset
+    np.save(os.path.join(tmp_dir, '{}_weights.npy'.format(i)), weights)
+    np.save(os.path.join(tmp_dir, '{}_bias.npy'.format(i)), bias)
+    layers[str(i)] = {
+      'name': str(layer['name'][0]),
+      'weights': '{}_weights.npy'.format(i),
+      'weights_shape': list(weights.shape),
+      'bias': '{}_bias.npy'.format(i),
+      'bias_shape': list(bias.shape)}
+  del vgg_rawnet, vgg_layers
+  stat = os.stat(model_weights)
+  manifest = {
+    'source': os.path.abspath(model_weights),
+    'source_size': stat.st_size,
+    'source_mtime': stat.st_mtime,
+    'source_sha1': file_sha1(model_weights),
+    'layers': layers}
+  with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+    json.dump(manifest, f, indent=2)
+  # swap the finished cache into place so readers never see a partial one
+  if os.path.exists(cache_dir) and read_cache_manifest(cache_dir, model_weights) is None:
+    check_cache_dir(cache_dir)
+    old_dir = '{}.{}.old'.format(cache_dir, os.getpid())
+    try:
+      os.rename(cache_dir, old_dir)
+      mapped_arrays.clear()
+      shutil.rmtree(old_dir)
+    except OSError:
+      pass # another process moved the stale cache away first
+  try:
+    os.rename(tmp_dir, cache_dir)
+  except OSError:
+    # another process finished converting first; its cache is the same
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def check_cache_dir(cache_dir):
+  # conversion replaces an existing cache_dir, so it may only hold an older cache
+  if os.path.exists(cache_dir) and not is_weight_cache(cache_dir):
+    raise ValueError('{} exists and is not a weight cache; give --weights_cache_dir '
+      'a new or empty directory'.format(cache_dir))
+
+def is_weight_cache(cache_dir):
+  # true if cache_dir holds nothing but the files listed in its manifest
+  if not os.path.isdir(cache_dir):
+    return False
+  entries = set(os.listdir(cache_dir))
+  if not entries:
+    return True
+  try:
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+      manifest = json.load(f)
+    files = set(['manifest.json'])
+    for layer in manifest['layers'].values():
+      files.update([layer['weights'], layer['bias']])
+  except (OSError, ValueError, KeyError, TypeError, AttributeError):
+    return False
+  return entries <= files
+
+def read_cache_manifest(cache_dir, model_weights):
+  # the manifest of a complete, up to date cache, else None
+  manifest_path = os.path.join(cache_dir, 'manifest.json')
+  if not os.path.exists(manifest_path):
+    return None
+  with open(manifest_path) as f:
+    manifest = json.load(f)
+  if is_stale_cache(manifest, model_weights):
+    return None
+  return manifest
+
+def is_stale_cache(manifest, model_weights):
+  if not os.path.exists(model_weights):
+    return False # the cache can outlive the .mat file
+  stat = os.stat(model_weights)
+  return manifest['source_size'] != stat.st_size or \
+    manifest['source_mtime'] != stat.st_mtime
+
+def load_vgg_layers(model_weights):
+  if model_weights == 'random':
+    return get_random_vgg_layers(args.seed)
+  cache_dir = get_weights_cache_dir(model_weights)
+  manifest = read_cache_manifest(cache_dir, model_weights)
+  if manifest is None:
+    if not os.path.exists(model_weights):
+      raise OSError(errno.ENOENT, "No such file", model_weights)
+    convert_weights(model_weights, cache_dir)
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+      manifest = json.load(f)
+  return {'dir': cache_dir, 'manifest': manifest}
+
+def get_cached_array(vgg_layers, i, kind):
+  if 'arrays' in vgg_layers:
+    return vgg_layers['arrays'][str(i)][kind]
+  layer = vgg_layers['manifest']['layers'][str(i)]
+  path = os.path.join(vgg_layers['dir'], layer[kind])
+  if path not in mapped_arrays:
+    mapped_arrays[path] = np.load(path, mmap_mode='r')
+  return mapped_arrays[path]
+
+# random weights already generated in this process, by seed
+random_layers = {}
+
+def get_random_vgg_layers(seed):
+  # he-initialized weights with the backbone's shapes, so runs work without the .mat
+  layer_table = BACKBONES[args.backbone]['layers']
+  key = (seed, layer_table)
+  if key not in random_layers:
+    rng = np.random.RandomState(seed)
+    channels = {'1': 64, '2': 128, '3': 256, '4': 512, '5': 512}
+    in_channels = 3
+    arrays = {}
+    for name, i in layer_table:
+      if not name.startswith('conv'):
+        continue
+      out_channels = channels[name[4]]
+      std = np.sqrt(2. / (3 * 3 * in_channels))
+      arrays[str(i)] = {
+        'weights': (rng.randn(3, 3, in_channels, out_channels) * std).astype(np.float32),
+        'bias': np.zeros(out_channels, dtype=np.float32)}
+      in_channels = out_channels
+    random_layers[key] = {'dir': None, 'arrays': arrays,
+      'manifest': {'source_sha1': 'random-{}'.format(seed)}}
+  return random_layers[key]
+
+def get_weights_id(vgg_layers):
+  return vgg_layers['manifest']['source_sha1']
+
 '''
   'a neural algorithm for artistic style' loss functions
 '''
@@ -276,12 +960,14 @@ def content_layer_loss(p, x):
   loss = K * tf.reduce_sum(tf.pow((x - p), 2))
   return loss
 
-def style_layer_loss(a, x):
-  _, h, w, d = a.get_shape()
+def style_layer_loss(A, x, sample_rate=1.):
+  _, h, w, d = x.get_shape()
   M = h.value * w.value
   N = d.value
-  A = gram_matrix(a, M, N)
-  G = gram_matrix(x, M, N)
+  if sample_rate < 1.:
+    G = sampled_gram_matrix(x, M, N, sample_rate)
+  else:
+    G = gram_matrix(x, M, N)
   loss = (1./(4 * N**2 * M**2)) * tf.reduce_sum(tf.pow((G - A), 2))
   return loss
 
@@ -290,33 +976,190 @@ def gram_matrix(x, area, depth):
   G = tf.matmul(tf.transpose(F), F)
   return G
 
-def sum_style_losses(sess, net, style_imgs):
+def sampled_gram_matrix(x, area, depth, rate):
+  # unbiased estimate of the gram matrix from a subset of spatial positions,
+  # resampled every time the graph runs
+  F = tf.reshape(x, (area, depth))
+  k = max(1, int(area * rate))
+  if args.style_sample_mode == 'strided':
+    stride = area // k
+    offset = tf.random.uniform([], 0, stride, dtype=tf.int32)
+    rows = offset + tf.range(k) * stride
+  else:
+    rows = tf.random.uniform([k], 0, area, dtype=tf.int32)
+  F = tf.gather(F, rows)
+  G = tf.matmul(tf.transpose(F), F) * (float(area) / float(k))
+  return G
+
+def get_style_sample_rates():
+  if args.style_sample_rates is None:
+    return [1.] * len(args.style_layers)
+  if len(args.style_sample_rates) == 1:
+    return args.style_sample_rates * len(args.style_layers)
+  return args.style_sample_rates
+
+def sum_style_losses(net, shared_targets=None):
+  # gram targets are non-trainable variables so one graph serves many styles;
+  # shared_targets are the targets of another input optimized in the same graph
   total_style_loss = 0.
-  weights = args.style_imgs_weights
-  for img, img_weight in zip(style_imgs, weights):
-    sess.run(net['input'].assign(img))
+  total_exact_loss = 0.
+  rates = get_style_sample_rates()
+  sampled = any(rate < 1. for rate in rates)
+  # style image weight times layer weight, loaded per job
+  net['style_layer_weights'] = tf.Variable(
+    np.zeros((len(args.style_imgs), len(args.style_layers)), dtype=np.float32), trainable=False)
+  net['style_targets'] = []
+  for index in range(len(args.style_imgs)):
+    targets = {}
     style_loss = 0.
-    for layer, weight in zip(args.style_layers, args.style_layer_weights):
-      a = sess.run(net[layer])
+    exact_loss = 0.
+    for k, (layer, rate) in enumerate(zip(args.style_layers, rates)):
+      weight = net['style_layer_weights'][index, k]
       x = net[layer]
-      a = tf.convert_to_tensor(a)
-      style_loss += style_layer_loss(a, x) * weight
+      N = x.get_shape()[3].value
+      if shared_targets is None:
+        A = tf.Variable(np.zeros((N, N), dtype=np.float32), trainable=False)
+      else:
+        A = shared_targets[index][layer]
+      targets[layer] = A
+      with tf.name_scope('style_' + layer):
+        style_loss += style_layer_loss(A, x, rate) * weight
+        if sampled:
+          exact_loss += style_layer_loss(A, x) * weight
     style_loss /= float(len(args.style_layers))
-    total_style_loss += (style_loss * img_weight)
-  total_style_loss /= float(len(style_imgs))
+    total_style_loss += style_loss
+    if sampled:
+      exact_loss /= float(len(args.style_layers))
+      total_exact_loss += exact_loss
+    net['style_targets'].append(targets)
+  total_style_loss /= float(len(args.style_imgs))
+  if sampled:
+    # only evaluated when reporting, never part of the optimized loss
+    net['style_loss'] = total_style_loss
+    net['style_loss_exact'] = total_exact_loss / float(len(args.style_imgs))
   return total_style_loss
 
-def sum_content_losses(sess, net, content_img):
-  sess.run(net['input'].assign(content_img))
+def report_sampling_quality(sess, net, run_info, samples=10):
+  exact = float(sess.run(net['style_loss_exact']))
+  estimates = [float(sess.run(net['style_loss'])) for _ in range(samples)]
+  mean = float(np.mean(estimates))
+  run_info['style_sample_rates'] = get_style_sample_rates()
+  run_info['style_sample_mode'] = args.style_sample_mode
+  run_info['style_loss_exact'] = exact
+  run_info['style_loss_sampled_mean'] = mean
+  run_info['style_loss_sampled_std'] = float(np.std(estimates))
+  run_info['style_loss_rel_error'] = abs(mean - exact) / max(abs(exact), 1e-12)
+  if args.verbose:
+    print('sampled style loss {} +/- {} vs exact {} (relative error {})'.format(
+      mean, run_info['style_loss_sampled_std'], exact, run_info['style_loss_rel_error']))
+
+'''
+  style gram target cache
+  remark: keyed by style file hash, resized shape, layer and model weights,
+  so a style reused across jobs is only pushed through the network once.
+'''
+# style file hashes already computed in this process
+style_hashes = {}
+
+def get_style_hash(style_fn):
+  path = os.path.join(args.style_imgs_dir, style_fn)
+  if path not in style_hashes:
+    style_hashes[path] = file_sha1(path)
+  return style_hashes[path]
+
+def get_gram_cache_path(style_fn, shape, layer, weights_id):
+  key = '{}|{}|{}|{}'.format(get_style_hash(style_fn),
+    'x'.join(str(int(i)) for i in shape), layer, weights_id)
+  name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy'
+  return os.path.join(args.gram_cache_dir, name)
+
+def compute_gram(a):
+  _, h, w, d = a.shape
+  F = np.reshape(a, (h * w, d))
+  return np.dot(F.T, F)
+
+def save_array(path, arr):
+  # write to a temporary file first so concurrent jobs never read a partial one
+  tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    np.save(f, arr)
+  os.replace(tmp_path, path)
+
+def lookup_style_grams(net, img, style_fn):
+  grams = {}
+  if not args.no_gram_cache:
+    for layer in args.style_layers:
+      path = get_gram_cache_path(style_fn, img.shape, layer, net['weights_id'])
+      if os.path.exists(path):
+        grams[layer] = np.load(path)
+  missing = [layer for layer in args.style_layers if layer not in grams]
+  if args.verbose:
+    print('style {}: {} cached gram targets, {} to compute'.format(style_fn,
+      len(grams), len(missing)))
+  return grams, missing
+
+def store_style_grams(net, img, style_fn, grams, layers):
+  if args.no_gram_cache:
+    return
+  maybe_make_directory(args.gram_cache_dir)
+  for layer in layers:
+    path = get_gram_cache_path(style_fn, img.shape, layer, net['weights_id'])
+    save_array(path, grams[layer])
+
+def sum_content_losses(net, shared_targets=None):
   content_loss = 0.
-  for layer, weight in zip(args.content_layers, args.content_layer_weights):
-    p = sess.run(net[layer])
+  net['content_targets'] = {}
+  # loaded per job
+  net['content_layer_weights'] = tf.Variable(
+    np.zeros(len(args.content_layers), dtype=np.float32), trainable=False)
+  for k, layer in enumerate(args.content_layers):
+    weight = net['content_layer_weights'][k]
     x = net[layer]
-    p = tf.convert_to_tensor(p)
-    content_loss += content_layer_loss(p, x) * weight
+    if shared_targets is None:
+      p = tf.Variable(np.zeros(x.get_shape().as_list(), dtype=np.float32), trainable=False)
+    else:
+      p = shared_targets[layer]
+    net['content_targets'][layer] = p
+    with tf.name_scope('content_' + layer):
+      content_loss += content_layer_loss(p, x) * weight
   content_loss /= float(len(args.content_layers))
   return content_loss
 
+'''
+  target extraction
+  remark: the content image and every style image with uncached grams are
+  stacked into one batch and all required layers are fetched in one run.
+'''
+@timed_phase('target_extraction')
+def set_targets(sess, net, content_img, style_imgs, style_grams=None):
+  batch = [content_img]
+  fetch_layers = set(args.content_layers)
+  pending = []
+  if style_grams is None:
+    style_grams = []
+    for img, img_fn in zip(style_imgs, args.style_imgs):
+      grams, missing = lookup_style_grams(net, img, img_fn)
+      style_grams.append(grams)
+      if missing:
+        pending.append((len(batch), img, img_fn, grams, missing))
+        batch.append(img)
+        fetch_layers.update(missing)
+  fetch_layers = sorted(fetch_layers)
+  acts = sess.run([net['targets'][layer] for layer in fetch_layers],
+    feed_dict={net['targets_input']: np.concatenate(batch, axis=0)})
+  acts = dict(zip(fetch_layers, acts))
+
+  for layer, p in net['content_targets'].items():
+    p.load(acts[layer][0:1], sess)
+  for index, img, img_fn, grams, missing in pending:
+    for layer in missing:
+      grams[layer] = compute_gram(acts[layer][index:index+1])
+    store_style_grams(net, img, img_fn, grams, missing)
+  for grams, targets in zip(style_grams, net['style_targets']):
+    for layer, A in targets.items():
+      A.load(grams[layer], sess)
+  return style_grams
+
 '''
   utilities and i/o
 '''
@@ -332,6 +1175,71 @@ def write_image(path, img):
   img = postprocess(img)
   cv2.imwrite(path, img)
 
+@timed_phase('output')
+def write_image_async(path, img):
+  # snapshot the array so the optimizer can keep updating its own copy
+  submit_output(write_image, path, np.array(img, copy=True))
+
+'''
+  background output writer
+  remark: image encoding, disk writes and plots run on a bounded thread
+  pool.  submitting blocks while --output_queue writes are pending, so a
+  slow disk slows the optimizer instead of growing memory without bound.
+'''
+class OutputWriter(object):
+  def __init__(self, workers, max_pending):
+    self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+    self.slots = threading.BoundedSemaphore(max_pending)
+    self.lock = threading.Lock()
+    self.futures = []
+
+  def submit(self, fn, *fn_args):
+    self.slots.acquire()
+    try:
+      future = self.pool.submit(fn, *fn_args)
+    except:
+      self.slots.release()
+      raise
+    future.add_done_callback(lambda f: self.slots.release())
+    with self.lock:
+      self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+      self.futures.append(future)
+
+  def flush(self):
+    with self.lock:
+      futures, self.futures = self.futures, []
+    # re-raise the first failed write
+    for future in futures:
+      future.result()
+
+  def close(self):
+    try:
+      self.flush()
+    finally:
+      self.pool.shutdown()
+
+output_writer = None
+
+def submit_output(fn, *fn_args):
+  global output_writer
+  if args.output_workers <= 0:
+    fn(*fn_args)
+    return
+  if output_writer is None:
+    output_writer = OutputWriter(args.output_workers, args.output_queue)
+  output_writer.submit(fn, *fn_args)
+
+@timed_phase('output')
+def flush_outputs():
+  if output_writer is not None:
+    output_writer.flush()
+
+def close_outputs():
+  global output_writer
+  if output_writer is not None:
+    writer, output_writer = output_writer, None
+    writer.close()
+
 def preprocess(img):
   imgpre = np.copy(img)
   # bgr to rgb
@@ -358,8 +1266,8 @@ def normalize(weights):
   else: return [0.] * len(weights)
 
 def maybe_make_directory(dir_path):
-  if not os.path.exists(dir_path):  
-    os.makedirs(dir_path)
+  # parallel workers may create the same directory at the same time
+  os.makedirs(dir_path, exist_ok=True)
 
 def check_image(img, path):
   if img is None:
@@ -368,95 +1276,670 @@ def check_image(img, path):
 '''
   rendering -- where the magic happens
 '''
-def stylize(content_img, style_imgs, init_img, frame=None):
-  with tf.device(args.device), tf.Session() as sess:
+# extra facts about the last stylize() run, written to meta_data.txt
+run_info = {}
+
+def stylize(content_img, style_imgs, init_img, frame=None, style_grams=None, stylizer=None):
+  if stylizer is None:
+    stylizer = get_stylizer(content_img)
+  sess, net = stylizer['sess'], stylizer['net']
+  if args.verbose and frame is not None: print('\n---- FRAME {} ----'.format(frame))
+  with stylizer['graph'].as_default(), sess.as_default():
+    # reset the input and optimizer state left over from a previous job
+    sess.run(stylizer['init_op'])
+
+    # style and content targets
+    stylizer['style_grams'] = set_targets(sess, net, content_img, style_imgs, style_grams)
+
+    # loss weights and optimizer settings
+    load_job_params(sess, net)
+
+    output_img = optimize(sess, stylizer, init_img)
+
+  return output_img
+
+def load_job_params(sess, net):
+  # weights and adam settings are variables, so jobs that only change them
+  # share a graph; loaded after init_op has reset the variables
+  alpha = args.content_weight
+  beta  = args.style_weight
+  theta = args.tv_weight
+  net['loss_weights'].load([alpha, beta, theta], sess)
+  net['content_layer_weights'].load(args.content_layer_weights, sess)
+  net['style_layer_weights'].load(np.outer(args.style_imgs_weights, args.style_layer_weights), sess)
+  if 'adam_params' in net:
+    net['adam_params'].load([args.learning_rate, args.beta1, args.beta2, args.epsilon], sess)
+    sess.run(net['reset_adam'])
+
+def optimize(sess, stylizer, init_img):
+  # runs the configured optimizer on the stylizer's input, from init_img.
+  # the records are kept per call (tile workers optimize concurrently) and
+  # published to the module globals once the call is done
+  net = stylizer['net']
+  L_total = stylizer['loss']
+  history = {'loss': [], 'time': [], 'mem': None, 'start': time.time(), 'info': {}}
+  info = history['info']
+  info.update(net.get('precision_info', {}))
+  info.update(net.get('recompute_info', {}))
+
+  with timed_phase('optimization'):
+    if args.optimizer == 'adam':
+      minimize, optimizer = minimize_with_adam, stylizer['train_op']
+    elif args.optimizer == 'lbfgs':
+      minimize = minimize_with_lbfgs_graph if args.lbfgs_impl == 'graph' else minimize_with_lbfgs
+      optimizer = stylizer['optimizer']
+    minimize_args = (sess, net, optimizer, init_img, L_total, history)
+    if args.mem:
+      history['mem'] = memory_usage(proc=(minimize, minimize_args), interval=args.mem_interval)
+    else:
+      minimize(*minimize_args)
+  
+  # the time and memory side of --recompute_segments and --precision
+  info['time_per_iteration'] = (history['time'][-1] if history['time'] else 0.) / max(1, info.get('stop_iteration', 1))
+  if history['mem']:
+    info['peak_mem_mib'] = max(history['mem'])
+  if args.verbose and 'recompute_info' in net:
+    print('recompute {}: {:.1f}ms per iteration, peak memory {}'.format(
+      ' '.join(args.recompute_segments), 1000. * info['time_per_iteration'],
+      '{:.0f} MiB'.format(info['peak_mem_mib']) if history['mem'] else 'not sampled (--mem)'))
+
+  output_img = sess.run(net['input'])
+
+  if 'style_loss_exact' in net:
+    report_sampling_quality(sess, net, info)
+  stylizer['history'] = history
+  publish_history(history)
+  return output_img
+
+# vectors of the losses, times and memory samples of the last optimize()
+loss_vec = []
+time_vec = []
+mem_vec = None
+time_start = None
+history_lock = threading.Lock()
+
+def publish_history(history):
+  global loss_vec, time_vec, mem_vec, time_start
+  with history_lock:
+    loss_vec, time_vec, mem_vec = history['loss'], history['time'], history['mem']
+    time_start = history['start']
+    run_info.clear()
+    run_info.update(history['info'])
+
+'''
+  stylizer graphs
+  remark: the network, loss and optimizer are built once per configuration
+  and kept with an open session, so later jobs of the same shape only load
+  new targets, weights and adam settings and reset the input image.  only
+  what changes the graph is in the key.  stylizers are kept in order of
+  last use, and the max_cached_stylizers most recent ones stay open.
+'''
+stylizers = {}
+max_cached_stylizers = 1
+
+def get_stylizer_key(shape):
+  key = [shape, args.optimizer, args.backbone, args.model_weights, args.device,
+    len(args.style_imgs), tuple(args.content_layers), tuple(args.style_layers),
+    tuple(get_style_sample_rates()), args.style_sample_mode, args.xla, args.precision,
+    tuple(args.recompute_segments)]
+  if args.optimizer == 'lbfgs':
+    key += [args.lbfgs_impl, args.lbfgs_history]
+    if args.lbfgs_impl == 'scipy':
+      key += [args.max_iterations, args.print_iterations, args.verbose]
+  return tuple(key)
+
+def get_stylizer(content_img):
+  key = get_stylizer_key(content_img.shape)
+  if key not in stylizers:
+    # least recently used first
+    for old_key in list(stylizers.keys())[:max(0, len(stylizers) - max_cached_stylizers + 1)]:
+      close_stylizer(old_key)
+    stylizers[key] = build_stylizer(content_img)
+  else:
+    if args.verbose: print('\nREUSING NETWORK FOR SHAPE {}'.format(content_img.shape))
+    stylizers[key] = stylizers.pop(key)
+  return stylizers[key]
+
+@timed_phase('graph_build')
+def build_stylizer(content_img):
+  graph = tf.Graph()
+  with graph.as_default(), tf.device(args.device), resource_variable_scope():
     # setup network
     net = build_model(content_img)
     
-    # style loss
-    L_style = sum_style_losses(sess, net, style_imgs)
-    
-    # content loss
-    L_content = sum_content_losses(sess, net, content_img)
-    
-    # denoising loss
-    L_tv = tf.image.total_variation(net['input'])
-    
-    # loss weights
-    alpha = args.content_weight
-    beta  = args.style_weight
-    theta = args.tv_weight
-    
-    # total loss
-    L_total  = alpha * L_content
-    L_total += beta  * L_style
-    L_total += theta * L_tv
-       
-    # optimization algorithm
-    optimizer = get_optimizer(L_total)
+    # losses, gradients and the adam update are compiled together with --xla
+    with get_jit_scope():
+      L_total = build_loss(net)
+      optimizer, train_op = build_optimizer(net, L_total)
+
+    init_op = tf.global_variables_initializer()
+  sess = tf.Session(graph=graph, config=get_session_config())
+  return {'graph': graph, 'sess': sess, 'net': net, 'loss': L_total,
+    'optimizer': optimizer, 'train_op': train_op, 'init_op': init_op}
+
+def build_loss(net, shared=None):
+  # shared is another input's net whose targets are reused
+  L_style = sum_style_losses(net, None if shared is None else shared['style_targets'])
+  L_content = sum_content_losses(net, None if shared is None else shared['content_targets'])
+
+  # denoising loss
+  L_tv = tf.image.total_variation(net['input'])
+
+  # loss weights, loaded per job
+  net['loss_weights'] = tf.Variable(np.zeros(3, dtype=np.float32), trainable=False)
+  net['loss_terms'] = [L_content, L_style, L_tv]
+  alpha, beta, theta = tf.unstack(net['loss_weights'])
+
+  # total loss
+  L_total  = alpha * L_content
+  L_total += beta  * L_style
+  L_total += theta * L_tv
+  return L_total
+
+def build_optimizer(net, L_total):
+  # only the input of this net is optimized, other inputs in the graph are not
+  train_op = None
+  if args.optimizer == 'lbfgs' and args.lbfgs_impl == 'graph':
+    optimizer = build_lbfgs(net, L_total)
+    # history buffers and the last iterate, saved with checkpoints
+    net['optimizer_vars'] = optimizer['variables']
+    return optimizer, train_op
+  adam_params = None
+  if args.optimizer == 'adam':
+    # learning rate, betas and epsilon, loaded per job
+    net['adam_params'] = tf.Variable(np.zeros(4, dtype=np.float32), trainable=False)
+    adam_params = tf.unstack(net['adam_params'])
+  optimizer = get_optimizer(L_total, [net['input']], adam_params)
+  if args.optimizer == 'adam':
+    train_op = optimizer.minimize(L_total, var_list=[net['input']])
+    # the beta powers start from the job's betas, not the ones at init_op
+    beta1_power, beta2_power = optimizer._get_beta_accumulators()
+    net['reset_adam'] = tf.group(beta1_power.assign(adam_params[1]),
+      beta2_power.assign(adam_params[2]))
+  if args.optimizer == 'lbfgs':
+    # the session half of an l-bfgs evaluation, for traced iterations
+    net['gradient'] = tf.gradients(L_total, net['input'])[0]
+  # adam slots and beta powers, saved with checkpoints
+  net['optimizer_vars'] = optimizer.variables() if args.optimizer == 'adam' else []
+  return optimizer, train_op
 
+'''
+  in-graph l-bfgs
+  remark: the last --lbfgs_history (s, y) pairs live in preallocated ring
+  buffers next to the input variable, so only scalars cross the session
+  boundary: one run computes the direction by the two-loop recursion, then
+  each line search trial moves the input and evaluates loss and gradient.
+  a pair with y.s <= 0 is not stored, which keeps the inverse hessian
+  estimate positive definite without a wolfe line search.
+'''
+def build_lbfgs(net, loss):
+  x = net['input']
+  shape = x.get_shape().as_list()
+  n = int(np.prod(shape))
+  m = args.lbfgs_history
+  def buffer(shape, name, dtype=tf.float32):
+    return tf.Variable(tf.zeros(shape, dtype=dtype), trainable=False, name=name)
+  with tf.name_scope('lbfgs'):
+    s_hist = buffer([m, n], 's_history')
+    y_hist = buffer([m, n], 'y_history')
+    rho = buffer([m], 'rho')
+    x_prev = buffer([n], 'x_prev')
+    g_prev = buffer([n], 'g_prev')
+    g = buffer([n], 'gradient')
+    d = buffer([n], 'direction')
+    # pairs stored and directions taken so far
+    n_pairs = buffer([], 'pairs', tf.int32)
+    n_steps = buffer([], 'steps', tf.int32)
+
+    # loss and gradient at the current input
+    x_flat = tf.reshape(x, [-1])
+    gradient = tf.reshape(tf.gradients(loss, x)[0], [-1])
+    net['gradient'] = gradient
+    evaluate = [tf.group(g.assign(gradient)), loss[0], tf.reduce_sum(gradient * d)]
+
+    # store the pair of the last step (masked, so no cond is needed under xla)
+    s = x_flat - x_prev
+    y = g - g_prev
+    ys = tf.reduce_sum(y * s)
+    keep = tf.logical_and(n_steps > 0, ys > 1e-10)
+    mask = tf.cast(keep, tf.float32)
+    slot = tf.floormod(n_pairs, m)
+    update = tf.group(
+      tf.scatter_update(s_hist, [slot], [mask * s + (1. - mask) * s_hist[slot]]),
+      tf.scatter_update(y_hist, [slot], [mask * y + (1. - mask) * y_hist[slot]]),
+      tf.scatter_update(rho, [slot], [mask / tf.maximum(ys, 1e-10) + (1. - mask) * rho[slot]]))
+    with tf.control_dependencies([update]):
+      pairs = n_pairs.assign_add(tf.cast(keep, tf.int32))
+
+    # two-loop recursion from the newest pair; unused slots have rho = 0
+    with tf.control_dependencies([pairs]):
+      s_mem, y_mem, rho_mem = s_hist.read_value(), y_hist.read_value(), rho.read_value()
+      q = g.read_value()
+    alphas = []
+    for i in range(m):
+      j = tf.floormod(pairs - 1 - i, m)
+      alpha = rho_mem[j] * tf.reduce_sum(s_mem[j] * q)
+      q -= alpha * y_mem[j]
+      alphas.append((j, alpha))
+    newest = tf.floormod(pairs - 1, m)
+    y_new = y_mem[newest]
+    gamma = tf.reduce_sum(s_mem[newest] * y_new) / tf.maximum(tf.reduce_sum(y_new * y_new), 1e-10)
+    r = tf.where(pairs > 0, gamma, tf.constant(1.)) * q
+    for j, alpha in reversed(alphas):
+      beta = rho_mem[j] * tf.reduce_sum(y_mem[j] * r)
+      r += s_mem[j] * (alpha - beta)
+    # the last iterate is overwritten only after its pair was stored
+    with tf.control_dependencies([pairs]):
+      direction = tf.group(d.assign(-r), x_prev.assign(x_flat), g_prev.assign(g),
+        n_steps.assign_add(1))
+    gtd = -tf.reduce_sum(g * r)
+    # without curvature pairs the step is scaled down, as in the first iteration
+    first_step = tf.minimum(1., 1. / tf.maximum(tf.reduce_sum(tf.abs(g)), 1e-10))
+    step = tf.where(pairs > 0, tf.constant(1.), first_step)
+
+    # a line search trial: input = x_prev + t * direction
+    t = tf.placeholder(tf.float32, [], name='step_size')
+    move = tf.group(x.assign(tf.reshape(x_prev + t * d, shape)))
+
+  return {'evaluate': evaluate, 'direction': [direction, gtd, step], 'move': move,
+    'step_size': t, 'variables': [s_hist, y_hist, rho, x_prev, g_prev, g, d, n_pairs, n_steps]}
 
-    # vectors to save losses and times at each iteration
-    global loss_vec, time_vec, mem_vec, time_start # (init time start in minimize_with_*)
-    loss_vec = []
-    time_vec = []
+'''
+  xla compilation
+  remark: ops built in the jit scope (the optimized tower, the losses, their
+  gradients and the adam update) are fused into xla clusters.  xla only
+  updates resource variables, so --xla builds every variable as one.  the
+  target tower is fed batches of varying size and stays uncompiled.
+'''
+def get_jit_scope():
+  if not args.xla:
+    return contextlib.nullcontext()
+  return tf.contrib.compiler.jit.experimental_jit_scope(compile_ops=True,
+    separate_compiled_gradients=False)
 
-    if args.optimizer == 'adam':
-      if args.mem:
-        mem_vec = memory_usage(proc=(minimize_with_adam, (sess, net, optimizer, init_img, L_total)), interval=1)
-      else:
-        minimize_with_adam(sess, net, optimizer, init_img, L_total)
-    elif args.optimizer == 'lbfgs':
-      if args.mem:
-        mem_vec = memory_usage(proc=(minimize_with_lbfgs, (sess, net, optimizer, init_img, L_total)), interval=1)
-      else:
-        minimize_with_lbfgs(sess, net, optimizer, init_img, L_total)
-    
-    output_img = sess.run(net['input'])
+def resource_variable_scope():
+  return tf.variable_scope(tf.get_variable_scope(),
+    use_resource=True if args.xla else None)
 
-    write_image_output(output_img, content_img, style_imgs)
+def get_session_config():
+  config = tf.ConfigProto()
+  config.intra_op_parallelism_threads = args.intra_op_threads
+  config.inter_op_parallelism_threads = args.inter_op_threads
+  return config
 
-def append_loss(loss):
+def close_stylizer(key):
+  stylizers.pop(key)['sess'].close()
+
+def close_stylizers():
+  for key in list(stylizers.keys()):
+    close_stylizer(key)
+
+'''
+  checkpoints
+  remark: a checkpoint is one .npz (image, optimizer variables, loss/time
+  history and the run state as json) replaced atomically, so a killed job
+  loses at most --checkpoint_every iterations.  the graph l-bfgs history is
+  saved with the image; scipy keeps its curvature pairs to itself, so a
+  resumed scipy l-bfgs block rebuilds them.
+'''
+def get_checkpoint_path():
+  out_dir, _ = get_image_savename(args.blocks, 0)
+  return os.path.join(out_dir, 'checkpoint.npz')
+
+def get_checkpoint_config(net):
+  # everything that changes what a resumed run would be optimizing
+  return {'shape': net['input'].get_shape().as_list(), 'optimizer': args.optimizer,
+    'backbone': args.backbone, 'model_weights': args.model_weights,
+    'content_img': args.content_img,
+    'style_imgs': args.style_imgs, 'style_imgs_weights': args.style_imgs_weights,
+    'content_weight': args.content_weight, 'style_weight': args.style_weight,
+    'tv_weight': args.tv_weight, 'content_layers': args.content_layers,
+    'content_layer_weights': args.content_layer_weights,
+    'style_layers': args.style_layers, 'style_layer_weights': args.style_layer_weights,
+    'learning_rate': args.learning_rate, 'beta1': args.beta1, 'beta2': args.beta2,
+    'epsilon': args.epsilon, 'blocks': args.blocks, 'max_iterations': args.max_iterations,
+    'precision': args.precision, 'lbfgs_impl': args.lbfgs_impl,
+    'lbfgs_history': args.lbfgs_history}
+
+def is_checkpoint_due(steps):
+  return args.checkpoint_every > 0 and steps > 0 and steps % args.checkpoint_every == 0
+
+def save_checkpoint(sess, net, input_img, progress, losses, times):
+  path = get_checkpoint_path()
+  state = {'config': get_checkpoint_config(net), 'progress': progress, 'args': vars(args)}
+  arrays = {'input': input_img, 'losses': np.asarray(losses, dtype=np.float64),
+    'times': np.asarray(times, dtype=np.float64),
+    'state': np.array(json.dumps(state, default=str))}
+  for i, value in enumerate(sess.run(net['optimizer_vars'])):
+    arrays['optimizer_var_{}'.format(i)] = value
+  tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+  with open(tmp_path, 'wb') as f:
+    np.savez(f, **arrays)
+  os.replace(tmp_path, path)
+  if args.verbose: print('checkpoint saved: {}'.format(progress))
+
+def load_checkpoint(sess, net):
+  # restores the image and optimizer variables, returns the saved state
+  if not args.resume:
+    return None
+  path = get_checkpoint_path()
+  if not os.path.exists(path):
+    return None
+  with np.load(path) as data:
+    state = json.loads(str(data['state']))
+    config = json.loads(json.dumps(get_checkpoint_config(net)))
+    if state['config'] != config:
+      raise ValueError('{} was saved by a different configuration'.format(path))
+    net['input'].load(data['input'], sess)
+    for i, var in enumerate(net['optimizer_vars']):
+      var.load(data['optimizer_var_{}'.format(i)], sess)
+    state['losses'] = data['losses'].tolist()
+    state['times'] = data['times'].tolist()
+  if args.verbose: print('\nRESUMING FROM {}: {}'.format(path, state['progress']))
+  return state
+
+def remove_checkpoint():
+  path = get_checkpoint_path()
+  if os.path.exists(path):
+    os.remove(path)
+
+'''
+  early stopping
+'''
+class StopOptimization(Exception):
+  pass
+
+def get_stop_reason(losses, count, elapsed):
+  # losses[:count] are the losses recorded so far, one per iteration
+  if args.stop_loss is not None and losses[count-1] <= args.stop_loss:
+    return 'loss_target'
+  if args.time_budget is not None and elapsed >= args.time_budget:
+    return 'time_budget'
+  if args.stop_window > 0 and count > args.stop_window:
+    old, new = losses[count-1-args.stop_window], losses[count-1]
+    if old - new <= args.stop_rel_tol * abs(old):
+      return 'converged'
+  return None
+
+def record_stop(history, reason, iteration):
+  history['info']['stop_reason'] = reason
+  history['info']['stop_iteration'] = iteration
+  if args.verbose: print('stopped at iteration {}: {}'.format(iteration, reason))
+
+def append_loss(history, loss):
   f = loss[0]
   time_end = time.time()
-  global loss_vec, time_vec, time_start
-  loss_vec.append(f)
-  time_vec.append(time_end - time_start)
+  history['loss'].append(f)
+  history['time'].append(time_end - history['start'])
+  if is_logging():
+    log_iterations(len(history['loss']) - 1, [f], [history['time'][-1]], [get_rss_mib()])
 
-def minimize_with_lbfgs(sess, net, optimizer, init_img, loss):
+def minimize_with_lbfgs(sess, net, optimizer, init_img, loss, history):
   if args.verbose: print('\nMINIMIZING LOSS USING: L-BFGS OPTIMIZER')
-  init_op = tf.global_variables_initializer()
-  sess.run(init_op)
-  sess.run(net['input'].assign(init_img))
+  net['input'].load(init_img, sess)
+  input_shape = net['input'].get_shape().as_list()
+  # losses at accepted iterates, for the stopping criteria
+  step_losses = []
+  last_x = [None]
+  # iterations done in the current block, and where a resumed block ends
+  block_steps = [0]
+  block_limit = [None]
   block = 0
-  global time_start
-  time_start = time.time()
+  traced = set(args.trace_iterations)
+  def step_callback(xk):
+    last_x[0] = xk
+    step_losses.append(history['loss'][-1])
+    block_steps[0] += 1
+    if len(step_losses) in traced:
+      # re-evaluates loss and gradient at the accepted iterate; the gap to
+      # the iteration time in the log is the scipy side of the step
+      run_traced(sess, [loss, net['gradient']], len(step_losses))
+    if is_checkpoint_due(len(step_losses)):
+      if block_steps[0] >= args.max_iterations:
+        progress = {'block': block + 1, 'steps': 0}
+      else:
+        progress = {'block': block, 'steps': block_steps[0]}
+      progress['step_losses'] = [float(l) for l in step_losses]
+      save_checkpoint(sess, net, np.reshape(xk, input_shape), progress, history['loss'],
+        history['time'])
+    reason = get_stop_reason(step_losses, len(step_losses), time.time() - history['start'])
+    if reason is not None:
+      raise StopOptimization(reason)
+    if block_limit[0] is not None and block_steps[0] >= block_limit[0]:
+      raise StopOptimization('block_end')
+  reason = 'max_iterations'
+  resumed = load_checkpoint(sess, net)
+  if resumed is not None:
+    history['loss'], history['time'] = resumed['losses'], resumed['times']
+    step_losses.extend(resumed['progress']['step_losses'])
+    block = resumed['progress']['block']
+    if resumed['progress']['steps'] > 0:
+      block_limit[0] = args.max_iterations - resumed['progress']['steps']
+  history['start'] = time.time() - (history['time'][-1] if history['time'] else 0.)
   while block < args.blocks:
     if args.verbose: print('\nBLOCK {}'.format(block))
-    optimizer.minimize(sess, loss_callback=append_loss, fetches=[loss])
+    try:
+      optimizer.minimize(sess, loss_callback=lambda f: append_loss(history, f),
+        fetches=[loss], step_callback=step_callback)
+    except StopOptimization as e:
+      # scipy never returned, so put the last accepted iterate back
+      net['input'].load(np.reshape(last_x[0], input_shape), sess)
+      if str(e) != 'block_end':
+        reason = str(e)
+    block_steps[0] = 0
+    block_limit[0] = None
     if args.save_iters:
       output_img = sess.run(net['input'])
       out_dir, img_path = get_image_savename(block, args.max_iterations)
-      write_image(img_path, output_img)
+      write_image_async(img_path, output_img)
     block += 1
-
-def minimize_with_adam(sess, net, optimizer, init_img, loss):
+    if reason != 'max_iterations':
+      break
+  record_stop(history, reason, len(step_losses))
+  if args.checkpoint_every > 0 or args.resume:
+    remove_checkpoint()
+
+# callables run after every accepted graph l-bfgs iteration with
+# (sess, net, iteration, loss); the input variable holds the new iterate
+step_hooks = []
+
+# relative loss change below which l-bfgs stops, the default of scipy's L-BFGS-B
+LBFGS_FTOL = 2.2e-9
+
+def minimize_with_lbfgs_graph(sess, net, lbfgs, init_img, loss, history):
+  if args.verbose: print('\nMINIMIZING LOSS USING: L-BFGS OPTIMIZER (IN GRAPH)')
+  net['input'].load(init_img, sess)
+  # losses at accepted iterates, for the stopping criteria
+  step_losses = []
+  block = steps = 0
+  traced = set(args.trace_iterations)
+  resumed = load_checkpoint(sess, net)
+  if resumed is not None:
+    # the history buffers were restored with the image, so curvature is kept
+    history['loss'], history['time'] = resumed['losses'], resumed['times']
+    step_losses.extend(resumed['progress']['step_losses'])
+    block, steps = resumed['progress']['block'], resumed['progress']['steps']
+  history['start'] = time.time() - (history['time'][-1] if history['time'] else 0.)
+  _, f, _ = sess.run(lbfgs['evaluate'])
+  if resumed is None:
+    append_loss(history, [f]) # record initial loss
+  reason = None
+  while block < args.blocks and reason is None:
+    if args.verbose: print('\nBLOCK {}'.format(block))
+    while steps < args.max_iterations:
+      f_prev = f
+      f = run_lbfgs_iteration(sess, lbfgs, f, history, len(step_losses) + 1 in traced,
+        len(step_losses) + 1)
+      if f is None:
+        reason = 'line_search'
+        break
+      step_losses.append(f)
+      steps += 1
+      for hook in [lbfgs_step_output] + step_hooks:
+        hook(sess, net, len(step_losses), f)
+      if is_checkpoint_due(len(step_losses)):
+        if steps >= args.max_iterations:
+          progress = {'block': block + 1, 'steps': 0}
+        else:
+          progress = {'block': block, 'steps': steps}
+        progress['step_losses'] = step_losses
+        save_checkpoint(sess, net, sess.run(net['input']), progress, history['loss'],
+          history['time'])
+      reason = get_stop_reason(step_losses, len(step_losses), time.time() - history['start'])
+      if reason is None and f_prev - f <= LBFGS_FTOL * max(abs(f_prev), abs(f), 1.):
+        reason = 'converged'
+      if reason is not None:
+        break
+    # blocks only mark where images are saved; the history carries over
+    if args.save_iters:
+      out_dir, img_path = get_image_savename(block, args.max_iterations)
+      write_image_async(img_path, sess.run(net['input']))
+    block += 1
+    steps = 0
+  record_stop(history, reason or 'max_iterations', len(step_losses))
+  if args.checkpoint_every > 0 or args.resume:
+    remove_checkpoint()
+
+def run_lbfgs_iteration(sess, lbfgs, f0, history, trace, iteration):
+  # one direction and line search; returns the accepted loss, or None if no
+  # trial decreased the loss (the input is then back at the last iterate)
+  _, gtd0, t = sess.run(lbfgs['direction'])
+  if gtd0 >= 0.:
+    return None
+  for _ in range(20):
+    sess.run(lbfgs['move'], {lbfgs['step_size']: t})
+    if trace:
+      _, f, _ = run_traced(sess, lbfgs['evaluate'], iteration)
+      trace = False
+    else:
+      _, f, _ = sess.run(lbfgs['evaluate'])
+    append_loss(history, [f])
+    if args.lbfgs_line_search == 'none' or f <= f0 + 1e-4 * t * gtd0:
+      return float(f)
+    # minimum of the quadratic through f0, gtd0 and f, within [0.1, 0.5] of t
+    t = min(max(-gtd0 * t * t / (2. * (f - f0 - gtd0 * t)), 0.1 * t), 0.5 * t)
+  sess.run(lbfgs['move'], {lbfgs['step_size']: 0.})
+  sess.run(lbfgs['evaluate'])
+  return None
+
+def lbfgs_step_output(sess, net, iteration, loss):
+  # print output and save intermediary images, like adam
+  if iteration % args.print_iterations == 0:
+    if args.verbose:
+      print("At iterate {}\tf=  {}".format(iteration, loss))
+    if args.save_iters:
+      out_dir, img_path = get_image_savename(0, iteration)
+      write_image_async(img_path, sess.run(net['input']))
+
+def drain_losses(history, losses, times, start, end, rss=None):
+  history['loss'].extend(losses[start:end].tolist())
+  history['time'].extend(times[start:end].tolist())
+  if is_logging():
+    log_iterations(start, losses[start:end], times[start:end],
+      None if rss is None else rss[start:end])
+  return end
+
+def minimize_with_adam(sess, net, train_op, init_img, loss, history):
+  if args.separate_loss_eval:
+    minimize_with_adam_unfused(sess, net, train_op, init_img, loss, history)
+    return
   if args.verbose: print('\nMINIMIZING LOSS USING: ADAM OPTIMIZER')
-  train_op = optimizer.minimize(loss)
-  init_op = tf.global_variables_initializer()
-  sess.run(init_op)
-  sess.run(net['input'].assign(init_img))
-  block = 0
-  global time_start
-  time_start = time.time()
-  append_loss(loss.eval()) # record initial loss
-  while block < args.blocks:
+  net['input'].load(init_img, sess)
+  # losses are buffered and moved to the history every print_iterations steps
+  n_records = args.blocks * args.max_iterations + 1
+  losses = np.zeros(n_records, dtype=np.float64)
+  times = np.zeros(n_records, dtype=np.float64)
+  rss = np.full(n_records, np.nan) if is_logging() else None
+  traced = set(args.trace_iterations)
+  count = drained = 0
+  block = start_iteration = 0
+  reason = None
+  resumed = load_checkpoint(sess, net)
+  if resumed is not None:
+    # the restored history is already recorded, so it is not drained again
+    count = drained = len(resumed['losses'])
+    losses[:count] = resumed['losses']
+    times[:count] = resumed['times']
+    history['loss'], history['time'] = resumed['losses'], resumed['times']
+    block = resumed['progress']['block']
+    start_iteration = resumed['progress']['iteration']
+  history['start'] = time.time() - (times[count-1] if count > 0 else 0.)
+  while block < args.blocks and reason is None:
     if args.verbose: print('\nBLOCK {}'.format(block))
-    iteration = 0
+    iteration, start_iteration = start_iteration, 0
     while (iteration < args.max_iterations):
-      sess.run(train_op)
+      # the loss comes from the same forward pass as the update, so it is
+      # the loss before this step (the first one is the initial loss)
+      if count in traced:
+        _, curr_loss = run_traced(sess, [train_op, loss], count)
+      else:
+        _, curr_loss = sess.run([train_op, loss])
+      losses[count] = curr_loss[0]
+      times[count] = time.time() - history['start']
+      if rss is not None:
+        rss[count] = get_rss_mib() or np.nan
+      count += 1
+      reason = get_stop_reason(losses, count, times[count-1])
+      # print output and save intermediary images
+      if iteration % args.print_iterations == 0:
+        drained = drain_losses(history, losses, times, drained, count, rss)
+        if args.verbose: 
+          print("At iterate {}\tf=  {}".format(iteration, curr_loss))
+        if args.save_iters:
+          output_img = sess.run(net['input'])
+          out_dir, img_path = get_image_savename(block, iteration)
+          write_image_async(img_path, output_img)
+      iteration += 1
+      if reason is None and is_checkpoint_due(count):
+        progress = get_adam_progress(block, iteration)
+        save_checkpoint(sess, net, sess.run(net['input']), progress,
+          losses[:count], times[:count])
+      if reason is not None:
+        break
+    block += 1
+  losses[count] = loss.eval()[0] # record final loss
+  times[count] = time.time() - history['start']
+  if rss is not None:
+    rss[count] = get_rss_mib() or np.nan
+  count += 1
+  drain_losses(history, losses, times, drained, count, rss)
+  record_stop(history, reason or 'max_iterations', count - 1)
+  if args.checkpoint_every > 0 or args.resume:
+    remove_checkpoint()
+
+def get_adam_progress(block, iteration):
+  # where a resumed run picks up after the step just taken
+  if iteration >= args.max_iterations:
+    return {'block': block + 1, 'iteration': 0}
+  return {'block': block, 'iteration': iteration}
+
+def minimize_with_adam_unfused(sess, net, train_op, init_img, loss, history):
+  if args.verbose: print('\nMINIMIZING LOSS USING: ADAM OPTIMIZER')
+  net['input'].load(init_img, sess)
+  block = start_iteration = 0
+  resumed = load_checkpoint(sess, net)
+  if resumed is not None:
+    history['loss'], history['time'] = resumed['losses'], resumed['times']
+    block = resumed['progress']['block']
+    start_iteration = resumed['progress']['iteration']
+    history['start'] = time.time() - history['time'][-1]
+  else:
+    history['start'] = time.time()
+    append_loss(history, loss.eval()) # record initial loss
+  losses, times = history['loss'], history['time']
+  traced = set(args.trace_iterations)
+  reason = None
+  while block < args.blocks and reason is None:
+    if args.verbose: print('\nBLOCK {}'.format(block))
+    iteration, start_iteration = start_iteration, 0
+    while (iteration < args.max_iterations):
+      if len(losses) - 1 in traced:
+        run_traced(sess, train_op, len(losses) - 1)
+      else:
+        sess.run(train_op)
       curr_loss = loss.eval()
-      append_loss(curr_loss)
+      append_loss(history, curr_loss)
+      reason = get_stop_reason(losses, len(losses), times[-1])
       # print output and save intermediary images
       if iteration % args.print_iterations == 0:
         if args.verbose: 
@@ -464,22 +1947,32 @@ def minimize_with_adam(sess, net, optimizer, init_img, loss):
         if args.save_iters:
           output_img = sess.run(net['input'])
           out_dir, img_path = get_image_savename(block, iteration)
-          write_image(img_path, output_img)
+          write_image_async(img_path, output_img)
       iteration += 1
+      if reason is None and is_checkpoint_due(len(losses) - 1):
+        progress = get_adam_progress(block, iteration)
+        save_checkpoint(sess, net, sess.run(net['input']), progress, losses, times)
+      if reason is not None:
+        break
     block += 1
+  record_stop(history, reason or 'max_iterations', len(losses) - 1)
+  if args.checkpoint_every > 0 or args.resume:
+    remove_checkpoint()
 
-def get_optimizer(loss):
+def get_optimizer(loss, var_list=None, adam_params=None):
   print_iterations = args.print_iterations if args.verbose else 0
   if args.optimizer == 'lbfgs':
     optimizer = tf.contrib.opt.ScipyOptimizerInterface(
-      loss, method='L-BFGS-B',
+      loss, var_list=var_list, method='L-BFGS-B',
       options={'maxiter': args.max_iterations,
                   'disp': print_iterations})
   elif args.optimizer == 'adam':
-    optimizer = tf.train.AdamOptimizer(args.learning_rate, args.beta1, args.beta2, args.epsilon)
+    if adam_params is None:
+      adam_params = [args.learning_rate, args.beta1, args.beta2, args.epsilon]
+    optimizer = tf.train.AdamOptimizer(*adam_params)
   return optimizer
 
-def get_image_savename(block, iteration):
+def get_output_dir():
   if args.img_name != None:
     out_dir = os.path.join(args.img_output_dir, args.img_name)
   else:
@@ -492,11 +1985,33 @@ def get_image_savename(block, iteration):
                 +str(args.beta2)+','+str(args.epsilon)+')'
   elif args.optimizer == 'lbfgs':
     out_dir += 'LBFGS'
+    if args.lbfgs_impl == 'graph':
+      out_dir += '('+str(args.lbfgs_history)+','+args.lbfgs_line_search+')'
   elif args.optimizer == 'both':
     out_dir += 'BOTH'
   if args.blocks != 1:
     out_dir += str(args.blocks) + 'x'
-  out_dir += str(args.max_iterations)
+  out_dir += str(output_stage.get('iterations', args.max_iterations))
+  return out_dir
+
+# the pyramid level or video frame being rendered with its own budget
+output_stage = {}
+
+@contextlib.contextmanager
+def stage_iterations(name, iterations):
+  # args.max_iterations for one stage of a longer render; its snapshots stay
+  # in the run's output directory and are prefixed with the stage name
+  max_iterations = args.max_iterations
+  output_stage.update(name=name, iterations=max_iterations)
+  args.max_iterations = iterations
+  try:
+    yield
+  finally:
+    args.max_iterations = max_iterations
+    output_stage.clear()
+
+def get_image_savename(block, iteration):
+  out_dir = get_output_dir()
   # store intermediary images in 'iters' subfolder
   if block < args.blocks:
     out_dir = os.path.join(out_dir, 'iters')
@@ -506,22 +2021,24 @@ def get_image_savename(block, iteration):
     img_path = os.path.join(out_dir, args.img_name)
   else:
     if iteration != 'graph':
-      img_path = os.path.join(out_dir, str(block)+'.'+str(iteration)+'.png')
+      stage = output_stage['name'] + '.' if output_stage else ''
+      img_path = os.path.join(out_dir, stage+str(block)+'.'+str(iteration)+'.png')
     else:
       img_path = os.path.join(out_dir, 'graph.png')
 
   return out_dir, img_path
 
+@timed_phase('output')
 def write_image_output(output_img, content_img, style_imgs):
   out_dir, img_path = get_image_savename(args.blocks, 0)
   content_path = os.path.join(out_dir, '0content.png')
 
-  write_image(img_path, output_img)
-  write_image(content_path, content_img)
+  write_image_async(img_path, output_img)
+  write_image_async(content_path, content_img)
   index = 0
   for style_img in style_imgs:
     path = os.path.join(out_dir, str(index)+'_style.png')
-    write_image(path, style_img)
+    write_image_async(path, style_img)
     index += 1
   
   # save the configuration settings
@@ -539,22 +2056,41 @@ def write_image_output(output_img, content_img, style_imgs):
   f.write('content_layers: {}\n'.format(args.content_layers))
   f.write('style_layers: {}\n'.format(args.style_layers))
   f.write('optimizer_type: {}\n'.format(args.optimizer))
+  if args.optimizer == 'lbfgs':
+    f.write('lbfgs_impl: {}\n'.format(args.lbfgs_impl))
+    if args.lbfgs_impl == 'graph':
+      f.write('lbfgs_history: {}\n'.format(args.lbfgs_history))
+      f.write('lbfgs_line_search: {}\n'.format(args.lbfgs_line_search))
   f.write('training_blocks: {}\n'.format(args.blocks))
   f.write('max_iterations: {}\n'.format(args.max_iterations))
   f.write('max_image_size: {}\n'.format(args.max_size))
+  if args.tile_size > 0:
+    f.write('tile_size: {}\n'.format(args.tile_size))
+    f.write('tile_overlap: {}\n'.format(args.tile_overlap))
+  if args.pyramid_levels > 1:
+    f.write('pyramid_levels: {}\n'.format(args.pyramid_levels))
+    f.write('pyramid_iterations: {}\n'.format(get_pyramid_iterations()))
+  for key, value in run_info.items():
+    f.write('{}: {}\n'.format(key, value))
+  for name, seconds in sorted(phase_times.items()):
+    f.write('phase_{}: {:.3f}s\n'.format(name, seconds))
   f.close()
 
 '''
   image loading and processing
 '''
-def get_content_image(content_img):
+@timed_phase('image_load')
+def get_content_image(content_img, max_size=None):
   path = os.path.join(args.content_img_dir, content_img)
    # bgr image
   img = cv2.imread(path, cv2.IMREAD_COLOR)
   check_image(img, path)
+  return resize_content_image(img, max_size)
+
+def resize_content_image(img, max_size=None):
   img = img.astype(np.float32)
   h, w, d = img.shape
-  mx = args.max_size
+  mx = args.max_size if max_size is None else max_size
   # resize if > max size
   if h > w and h > mx:
     w = (float(mx) / float(h)) * w
@@ -565,6 +2101,7 @@ def get_content_image(content_img):
   img = preprocess(img)
   return img
 
+@timed_phase('image_load')
 def get_style_images(content_img):
   _, ch, cw, cd = content_img.shape
   style_imgs = []
@@ -580,49 +2117,476 @@ def get_style_images(content_img):
   return style_imgs
 
 def render_image():
+  if args.video_input is not None:
+    render_frames()
+    return
+  if args.tile_size > 0:
+    render_tiled()
+    return
+  if args.pyramid_levels > 1:
+    render_pyramid()
+    return
   content_img = get_content_image(args.content_img)
   style_imgs = get_style_images(content_img)
-  with tf.Graph().as_default():
-    if args.verbose: print('\n---- RENDERING IMAGE ----\n')
-    init_img = content_img # could replace with style img or noise
-    tick = time.time()
-    stylize(content_img, style_imgs, init_img)
-    tock = time.time()
-    if args.verbose: print('Elapsed time: {}'.format(tock - tick))
+  if args.verbose: print('\n---- RENDERING IMAGE ----\n')
+  init_img = content_img # could replace with style img or noise
+  tick = time.time()
+  output_img = stylize(content_img, style_imgs, init_img)
+  write_image_output(output_img, content_img, style_imgs)
+  tock = time.time()
+  if args.verbose: print('Elapsed time: {}'.format(tock - tick))
+
+'''
+  optimizer comparison
+  remark: --optimizer both reads the images, builds the network and extracts
+  the targets once, then gives every optimizer config its own input
+  variable, tower and optimizer in the same graph, sharing the target
+  variables.  configs run one after the other and each is
+  timed from the start of its own minimization.  a config's variables
+  (input, optimizer state, l-bfgs history) are only initialized when it
+  starts, so --mem does not charge a config for the state of the configs
+  after it; the state of the configs before it stays resident, so the
+  memory of later configs includes theirs.
+'''
+COMPARE_OPTIONS = {'learning_rate': float, 'beta1': float, 'beta2': float,
+  'epsilon': float, 'max_iterations': int, 'lbfgs_history': int}
+
+def parse_compare_config(spec):
+  # 'adam', 'lbfgs' or e.g. 'adam:learning_rate=1,beta1=0.9'
+  name, _, options = spec.partition(':')
+  if name not in ('adam', 'lbfgs'):
+    raise ValueError('unknown optimizer in --compare_configs {}'.format(spec))
+  config = {'optimizer': name}
+  for option in [o for o in options.split(',') if o]:
+    key, _, value = option.partition('=')
+    if key not in COMPARE_OPTIONS:
+      raise ValueError('--compare_configs cannot set {} (options: {})'.format(key,
+        ', '.join(sorted(COMPARE_OPTIONS))))
+    config[key] = COMPARE_OPTIONS[key](value)
+  return config
+
+def check_compare_dirs(configs):
+  # every config writes its images and meta data to its own directory
+  dirs = {}
+  for config in configs:
+    with config_args(config):
+      out_dir = get_output_dir()
+    if out_dir in dirs:
+      raise ValueError('--compare_configs {} and {} write to the same directory {}'.format(
+        get_config_label(dirs[out_dir]), get_config_label(config), out_dir))
+    dirs[out_dir] = config
+
+def get_config_label(config):
+  label = {'adam': 'Adam', 'lbfgs': 'L-BFGS'}[config['optimizer']]
+  options = ['{}={}'.format(key, value) for key, value in sorted(config.items())
+    if key != 'optimizer']
+  if options:
+    label += ' ({})'.format(', '.join(options))
+  return label
+
+@contextlib.contextmanager
+def config_args(config):
+  # args overridden by an optimizer config for the duration of the block
+  saved = dict((key, getattr(args, key)) for key in config)
+  for key, value in config.items():
+    setattr(args, key, value)
+  try:
+    yield
+  finally:
+    for key, value in saved.items():
+      setattr(args, key, value)
+
+@timed_phase('graph_build')
+def build_comparison(content_img, configs):
+  graph = tf.Graph()
+  branches = []
+  with graph.as_default(), tf.device(args.device), resource_variable_scope():
+    net = build_model(content_img)
+    shared_vars = tf.global_variables()
+    for index, config in enumerate(configs):
+      built = set(v.name for v in tf.global_variables())
+      with config_args(config):
+        if index == 0:
+          branch = net
+        else:
+          with tf.name_scope('config{}'.format(index)):
+            branch = build_input_net(content_img.shape, net['layer_table'], net['params'])
+        with get_jit_scope():
+          L_total = build_loss(branch, None if index == 0 else net)
+          optimizer, train_op = build_optimizer(branch, L_total)
+      branch_vars = [v for v in tf.global_variables() if v.name not in built]
+      branches.append({'net': branch, 'loss': L_total, 'optimizer': optimizer,
+        'train_op': train_op, 'init_op': tf.variables_initializer(branch_vars)})
+    init_op = tf.variables_initializer(shared_vars)
+  sess = tf.Session(graph=graph, config=get_session_config())
+  return {'graph': graph, 'sess': sess, 'net': net, 'branches': branches,
+    'init_op': init_op}
+
+def render_comparison(configs):
+  content_img = get_content_image(args.content_img)
+  style_imgs = get_style_images(content_img)
+  init_img = content_img
+  comparison = build_comparison(content_img, configs)
+  sess, net = comparison['sess'], comparison['net']
+  results = []
+  tick = time.time()
+  try:
+    with comparison['graph'].as_default(), sess.as_default():
+      sess.run(comparison['init_op'])
+      set_targets(sess, net, content_img, style_imgs)
+      for config, branch in zip(configs, comparison['branches']):
+        with config_args(config):
+          sess.run(branch['init_op'])
+          load_job_params(sess, branch['net'])
+          if args.verbose: print('\n---- RENDERING WITH {} ----\n'.format(get_config_label(config)))
+          output_img = optimize(sess, branch, init_img)
+          write_image_output(output_img, content_img, style_imgs)
+          results.append(get_comparison_result(config))
+  finally:
+    sess.close()
+  tock = time.time()
+  if args.verbose: print('Elapsed time: {}'.format(tock - tick))
+  return results
+
+def get_comparison_result(config):
+  out_dir, _ = get_image_savename(args.blocks, 0)
+  return {'label': get_config_label(config), 'loss': loss_vec, 'time': time_vec,
+    'mem': mem_vec, 'dir': out_dir}
+
+'''
+  coarse-to-fine rendering
+  remark: each level starts from the upsampled result of the previous one,
+  so most iterations run on small images and the full size stage starts
+  close to converged.
+'''
+def get_pyramid_sizes():
+  return [max(1, args.max_size // 2**(args.pyramid_levels - 1 - level))
+    for level in range(args.pyramid_levels)]
+
+def get_pyramid_iterations():
+  if args.pyramid_iterations is not None:
+    return args.pyramid_iterations
+  return [args.max_iterations] * args.pyramid_levels
+
+def resize_image(img, shape):
+  # resize a preprocessed (1, h, w, d) image to the (1, h, w, d) shape given
+  _, h, w, _ = shape
+  resized = cv2.resize(img[0], dsize=(w, h), interpolation=cv2.INTER_CUBIC)
+  return resized[np.newaxis,:,:,:].astype(np.float32)
+
+def render_pyramid():
+  global loss_vec, time_vec, mem_vec
+  all_loss, all_time, all_mem = [], [], []
+  output_img = None
+  tick = time.time()
+  for level, (size, iterations) in enumerate(zip(get_pyramid_sizes(), get_pyramid_iterations())):
+    if args.verbose:
+      print('\n---- RENDERING PYRAMID LEVEL {} | size={} | iterations={} ----\n'.format(
+        level, size, iterations))
+    content_img = get_content_image(args.content_img, size)
+    # style targets are recomputed at every scale
+    style_imgs = get_style_images(content_img)
+    if output_img is None:
+      init_img = content_img
+    else:
+      init_img = resize_image(output_img, content_img.shape)
+    time_offset = all_time[-1] if all_time else 0.
+    with stage_iterations('level{}'.format(level), iterations):
+      output_img = stylize(content_img, style_imgs, init_img)
+    all_loss += loss_vec
+    all_time += [t + time_offset for t in time_vec]
+    if mem_vec is not None:
+      all_mem += mem_vec
+  loss_vec, time_vec = all_loss, all_time
+  mem_vec = all_mem if args.mem else None
+  write_image_output(output_img, content_img, style_imgs)
+  tock = time.time()
+  if args.verbose: print('Elapsed time: {}'.format(tock - tick))
+
+'''
+  frame sequences
+  remark: the graph is built and the style targets are extracted once; each
+  frame starts from the previous stylized frame, so after the first one only
+  the content targets change and a few iterations are enough.
+'''
+def read_frames(video_input):
+  # bgr frames from a directory of images or a video file
+  if os.path.isdir(video_input):
+    exts = ('.jpg', '.jpeg', '.png', '.bmp')
+    for fn in sorted(os.listdir(video_input)):
+      if fn.lower().endswith(exts):
+        path = os.path.join(video_input, fn)
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        check_image(img, path)
+        yield img
+  else:
+    if not os.path.exists(video_input):
+      raise OSError(errno.ENOENT, "No such file", video_input)
+    capture = cv2.VideoCapture(video_input)
+    try:
+      while True:
+        ok, img = capture.read()
+        if not ok:
+          break
+        yield img
+    finally:
+      capture.release()
+
+def render_frames():
+  global loss_vec, time_vec, mem_vec
+  out_dir, _ = get_image_savename(args.blocks, 0)
+  frames_dir = os.path.join(out_dir, 'frames')
+  maybe_make_directory(frames_dir)
+  all_loss, all_time, all_mem = [], [], []
+  writer = None
+  output_img = style_imgs = style_grams = None
+  tick = time.time()
+  try:
+    for frame, img in enumerate(read_frames(args.video_input)):
+      content_img = resize_content_image(img)
+      if frame == 0:
+        style_imgs = get_style_images(content_img)
+        init_img = content_img
+        iterations = args.first_frame_iterations or args.max_iterations
+      else:
+        # warm start from the previous stylized frame
+        init_img = output_img
+        iterations = args.frame_iterations
+      time_offset = all_time[-1] if all_time else 0.
+      with stage_iterations('frame{:05d}'.format(frame), iterations):
+        output_img = stylize(content_img, style_imgs, init_img, frame=frame,
+          style_grams=style_grams)
+      if style_grams is None:
+        style_grams = stylizers[get_stylizer_key(content_img.shape)]['style_grams']
+      all_loss += loss_vec
+      all_time += [t + time_offset for t in time_vec]
+      if mem_vec is not None:
+        all_mem += mem_vec
+      write_image_async(os.path.join(frames_dir, 'frame_{:05d}.png'.format(frame)), output_img)
+      if args.video_fps > 0.:
+        if writer is None:
+          _, h, w, _ = output_img.shape
+          writer = cv2.VideoWriter(os.path.join(out_dir, 'output.avi'),
+            cv2.VideoWriter_fourcc(*'MJPG'), args.video_fps, (w, h))
+        writer.write(postprocess(output_img))
+  finally:
+    if writer is not None:
+      writer.release()
+  if output_img is None:
+    raise ValueError('No frames found in {}'.format(args.video_input))
+  run_info['frames'] = frame + 1
+  run_info['first_frame_iterations'] = args.first_frame_iterations or args.max_iterations
+  run_info['frame_iterations'] = args.frame_iterations
+  loss_vec, time_vec = all_loss, all_time
+  mem_vec = all_mem if args.mem else None
+  write_image_output(output_img, content_img, style_imgs)
+  tock = time.time()
+  if args.verbose: print('Elapsed time: {} ({} frames)'.format(tock - tick, frame + 1))
+
+'''
+  tiled rendering
+  remark: every tile is optimized against the same global style gram
+  targets (averaged over the tiles of the full size style image), so the
+  style stays consistent across tiles while the graph stays tile sized.
+'''
+def get_tile_starts(length, tile, overlap):
+  if length <= tile:
+    return [0]
+  stride = tile - overlap
+  starts = list(range(0, length - tile, stride))
+  starts.append(length - tile)
+  return starts
+
+def get_tiles(shape):
+  # all tiles share one shape so a single graph serves every tile
+  _, h, w, _ = shape
+  th, tw = min(args.tile_size, h), min(args.tile_size, w)
+  return [(y, x, th, tw)
+    for y in get_tile_starts(h, th, args.tile_overlap)
+    for x in get_tile_starts(w, tw, args.tile_overlap)]
+
+def crop_tile(img, tile):
+  y, x, th, tw = tile
+  return np.ascontiguousarray(img[:, y:y+th, x:x+tw, :])
+
+def get_tile_mask(tile, shape):
+  # linear ramps on the edges a tile shares with its neighbours
+  y, x, th, tw = tile
+  _, h, w, _ = shape
+  def ramp(length, start, total):
+    r = np.ones(length, dtype=np.float32)
+    n = min(args.tile_overlap, length // 2)
+    edge = (np.arange(n, dtype=np.float32) + 1.) / (n + 1.)
+    if start > 0:
+      r[:n] = edge
+    if start + length < total:
+      r[length-n:] = edge[::-1]
+    return r
+  return np.outer(ramp(th, y, h), ramp(tw, x, w))
+
+@timed_phase('target_extraction')
+def get_tiled_style_grams(sess, net, style_imgs, tiles):
+  style_grams = []
+  for img, style_fn in zip(style_imgs, args.style_imgs):
+    key_shape = tuple(img.shape) + (args.tile_size, args.tile_overlap)
+    grams = {}
+    if not args.no_gram_cache:
+      for layer in args.style_layers:
+        path = get_gram_cache_path(style_fn, key_shape, layer, net['weights_id'])
+        if os.path.exists(path):
+          grams[layer] = np.load(path)
+    missing = [layer for layer in args.style_layers if layer not in grams]
+    if args.verbose:
+      print('style {}: {} cached tiled gram targets, {} to compute over {} tiles'.format(
+        style_fn, len(grams), len(missing), len(tiles)))
+    if missing:
+      sums = dict((layer, 0.) for layer in missing)
+      for tile in tiles:
+        acts = sess.run([net['targets'][layer] for layer in missing],
+          feed_dict={net['targets_input']: crop_tile(img, tile)})
+        for layer, a in zip(missing, acts):
+          sums[layer] += compute_gram(a)
+      if not args.no_gram_cache:
+        maybe_make_directory(args.gram_cache_dir)
+      for layer in missing:
+        grams[layer] = (sums[layer] / float(len(tiles))).astype(np.float32)
+        if not args.no_gram_cache:
+          path = get_gram_cache_path(style_fn, key_shape, layer, net['weights_id'])
+          save_array(path, grams[layer])
+    style_grams.append(grams)
+  return style_grams
+
+def render_tiled():
+  global loss_vec, time_vec, mem_vec
+  content_img = get_content_image(args.content_img)
+  style_imgs = get_style_images(content_img)
+  tiles = get_tiles(content_img.shape)
+  if args.verbose:
+    print('\n---- RENDERING {} TILES OF {}x{} ----\n'.format(len(tiles), tiles[0][2], tiles[0][3]))
+  tick = time.time()
+  tile_img = crop_tile(content_img, tiles[0])
+  first = build_stylizer(tile_img)
+  with first['graph'].as_default():
+    style_grams = get_tiled_style_grams(first['sess'], first['net'], style_imgs, tiles)
+
+  _, h, w, d = content_img.shape
+  output = np.zeros((h, w, d), dtype=np.float32)
+  weight = np.zeros((h, w), dtype=np.float32)
+  pending = list(tiles)
+  finished = []
+  lock = threading.Lock()
+
+  def worker(index):
+    stylizer = first if index == 0 else build_stylizer(tile_img)
+    try:
+      while True:
+        with lock:
+          if not pending:
+            return
+          tile = pending.pop(0)
+        content_tile = crop_tile(content_img, tile)
+        tile_out = stylize(content_tile, None, content_tile,
+          style_grams=style_grams, stylizer=stylizer)
+        tile_loss = stylizer['sess'].run(stylizer['loss'])
+        mask = get_tile_mask(tile, content_img.shape)
+        y, x, th, tw = tile
+        with lock:
+          output[y:y+th, x:x+tw, :] += tile_out[0] * mask[:,:,np.newaxis]
+          weight[y:y+th, x:x+tw] += mask
+          finished.append((time.time() - tick, tile_loss[0]))
+          if args.verbose:
+            print('tile {}/{} done at ({}, {}) | loss={}'.format(len(finished),
+              len(tiles), y, x, tile_loss[0]))
+    finally:
+      stylizer['sess'].close()
+
+  def run_tiles():
+    n_workers = max(1, min(args.tile_workers, len(tiles)))
+    with concurrent.futures.ThreadPoolExecutor(n_workers) as pool:
+      for future in [pool.submit(worker, i) for i in range(n_workers)]:
+        future.result()
+
+  # per-tile optimization records are not kept; the graphs plot the final
+  # loss of each tile against the time it finished
+  profile_mem = args.mem
+  args.mem = False
+  try:
+    if profile_mem:
+      mem_vec = memory_usage(proc=(run_tiles, ()), interval=args.mem_interval)
+    else:
+      run_tiles()
+  finally:
+    args.mem = profile_mem
+  output_img = (output / weight[:,:,np.newaxis])[np.newaxis,:,:,:]
+  finished.sort()
+  time_vec = [t for t, _ in finished]
+  loss_vec = [l for _, l in finished]
+  write_image_output(output_img, content_img, style_imgs)
+  tock = time.time()
+  if args.verbose: print('Elapsed time: {}'.format(tock - tick))
+
+def get_plot_title():
+  return 'Image Size '+str(args.max_size)+', ' \
+      +str(args.blocks * args.max_iterations)+' Iterations'
 
 def plot_loss(a_time, a_loss, l_time, l_loss, path):
-  if a_loss != None:
-    plt.plot(a_time, a_loss, label='Adam')
-  if l_loss != None:
-    plt.plot(l_time, l_loss, label='L-BFGS')
-  plt.xlabel('Time (seconds)')
-  plt.ylabel('Loss')
-  plt.yscale('log')
-  plt.title('Image Size '+str(args.max_size)+', ' \
-      +str(args.blocks * args.max_iterations)+' Iterations')
-  plt.legend()
-  plt.savefig(path)
-  plt.clf()
+  curves = []
+  if a_loss is not None:
+    curves.append(('Adam', a_time, a_loss))
+  if l_loss is not None:
+    curves.append(('L-BFGS', l_time, l_loss))
+  plot_losses(curves, path)
+
+@timed_phase('output')
+def plot_losses(curves, path):
+  # copy the records so later runs cannot change them before the plot is drawn
+  curves = [(label, list(times), list(losses)) for label, times, losses in curves]
+  submit_output(save_loss_plot, curves, get_plot_title(), path)
+
+def save_loss_plot(curves, title, path):
+  # a figure per plot (no pyplot state) so plots can be drawn off the main thread
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  ax = fig.add_subplot(111)
+  for label, times, losses in curves:
+    ax.plot(times, losses, label=label)
+  ax.set_xlabel('Time (seconds)')
+  ax.set_ylabel('Loss')
+  ax.set_yscale('log')
+  ax.set_title(title)
+  ax.legend()
+  fig.savefig(path)
 
 def plot_mem(a_mem, l_mem, path):
-  if a_mem != None:
-    plt.plot(a_mem, label='Adam')
-  if l_mem != None:
-    plt.plot(l_mem, label='L-BFGS')
-  plt.xlabel('Time (seconds)')
-  plt.ylabel('Memory Usage (MiB)')
-  plt.title('Image Size '+str(args.max_size)+', ' \
-      +str(args.blocks * args.max_iterations)+' Iterations')
-  plt.legend()
-  plt.savefig(path)
-  plt.clf()
-
-def main():
-  tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR) # quiet TF errors
-  global args
-  args = parse_args()
+  curves = []
+  if a_mem is not None:
+    curves.append(('Adam', a_mem))
+  if l_mem is not None:
+    curves.append(('L-BFGS', l_mem))
+  plot_mems(curves, path)
+
+@timed_phase('output')
+def plot_mems(curves, path):
+  curves = [(label, list(mem)) for label, mem in curves]
+  submit_output(save_mem_plot, curves, args.mem_interval, get_plot_title(), path)
+
+def save_mem_plot(curves, interval, title, path):
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  ax = fig.add_subplot(111)
+  for label, mem in curves:
+    ax.plot(np.arange(len(mem)) * interval, mem, label=label)
+  ax.set_xlabel('Time (seconds)')
+  ax.set_ylabel('Memory Usage (MiB)')
+  ax.set_title(title)
+  ax.legend()
+  fig.savefig(path)
+
+def run_job():
   # store losses and time for each iteration, record memory usage of loss minimization function
   global loss_vec, time_vec, mem_vec 
+  optimizer = args.optimizer
+  reset_phase_times()
 
   if args.optimizer == 'adam':
     render_image()
@@ -641,32 +2605,135 @@ def main():
       plot_mem(None, mem_vec, mem_path)
 
   elif args.optimizer == 'both':
+    check_compare_dirs(args.compare_configs)
     both_dir, img_path = get_image_savename(args.blocks, 'graph')
-    # Generate data for adam optimizer
-    args.optimizer = 'adam'
-    adam_dir, _ = get_image_savename(args.blocks, 0)
-    render_image()
-    a_loss, a_time, a_mem = loss_vec, time_vec, mem_vec
-    #print('losses:', len(loss_vec), loss_vec)
-    #print('times:', len(time_vec), time_vec)
-    #print('mem:', mem_vec)
-    # generate data for lbfgs
-    args.optimizer = 'lbfgs'
-    lbfgs_dir, _ = get_image_savename(args.blocks, 0)
-    render_image()
-    l_loss, l_time, l_mem = loss_vec, time_vec, mem_vec
-    #print('losses:', len(loss_vec), loss_vec)
-    #print('times:', len(time_vec), time_vec)
-    #print('mem:', mem_vec)
+    if args.video_input is None and args.tile_size == 0 and args.pyramid_levels == 1:
+      results = render_comparison(args.compare_configs)
+    else:
+      # frames, tiles and pyramids build their own graphs per config
+      results = []
+      for config in args.compare_configs:
+        with config_args(config):
+          render_image()
+          results.append(get_comparison_result(config))
     # generate graph, copy output to both_dir
+    flush_outputs() # pending writes must land before the directories move
     shutil.rmtree(both_dir)  # clear old experiments with same name
     maybe_make_directory(both_dir)
-    plot_loss(a_time, a_loss, l_time, l_loss, img_path)
+    plot_losses([(r['label'], r['time'], r['loss']) for r in results], img_path)
     if args.mem:
       mem_path = os.path.join(both_dir, 'mem_graph.png')
-      plot_mem(a_mem, l_mem, mem_path)
-    shutil.move(adam_dir, os.path.join(both_dir, Path(adam_dir).relative_to(args.img_output_dir)))
-    shutil.move(lbfgs_dir, os.path.join(both_dir, Path(lbfgs_dir).relative_to(args.img_output_dir)))
+      plot_mems([(r['label'], r['mem']) for r in results], mem_path)
+    flush_outputs()
+    for out_dir in sorted(set(r['dir'] for r in results)):
+      shutil.move(out_dir, os.path.join(both_dir, Path(out_dir).relative_to(args.img_output_dir)))
+
+  # wait for the background writes so output time is part of the job
+  flush_outputs()
+  report_phase_times(optimizer)
+
+'''
+  batch jobs
+  remark: jobs are grouped by stylizer key (shape and graph structure), so
+  a graph and session are only rebuilt when those change; weights and adam
+  settings are loaded per job.
+'''
+def load_manifest(path):
+  if path.endswith('.csv'):
+    with open(path, newline='') as f:
+      jobs = [dict(row) for row in csv.DictReader(f)]
+    for job in jobs:
+      # multi-valued columns are space separated
+      for key, value in list(job.items()):
+        if value is None or value.strip() == '':
+          del job[key]
+        elif ' ' in value.strip():
+          job[key] = value.split()
+  else:
+    with open(path) as f:
+      jobs = json.load(f)
+  return jobs
+
+def job_to_argv(job):
+  argv = []
+  for key, value in job.items():
+    flag = '--' + key
+    if isinstance(value, bool) or str(value).lower() in ('true', 'false'):
+      if value is True or str(value).lower() == 'true':
+        argv.append(flag)
+    elif isinstance(value, (list, tuple)):
+      argv += [flag] + [str(v) for v in value]
+    else:
+      argv += [flag, str(value)]
+  return argv
+
+def strip_batch_argv(argv):
+  stripped = []
+  skip = False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif arg == '--batch':
+      skip = True
+    elif not arg.startswith('--batch='):
+      stripped.append(arg)
+  return stripped
+
+def load_batch_jobs(manifest_path, base_argv):
+  # parses every job of a manifest, with jobs of the same graph adjacent so
+  # each is built once; a job with bad options or a missing image is
+  # reported like a failed run
+  global args
+  jobs = []
+  failed = []
+  manifest = load_manifest(manifest_path)
+  for index, job in enumerate(manifest):
+    try:
+      args = parse_args(base_argv + job_to_argv(job))
+      shape = get_content_image(args.content_img).shape
+    except (SystemExit, Exception) as e:
+      print('batch job {} is invalid: {}'.format(index, e))
+      failed.append(index)
+      continue
+    jobs.append({'index': index, 'job': job, 'args': args, 'shape': shape,
+      'key': str(get_stylizer_key(shape))})
+  jobs.sort(key=lambda job: (job['shape'], job['key'], job['index']))
+  return manifest, jobs, failed
+
+def run_batch(manifest_path):
+  global args
+  manifest, jobs, failed = load_batch_jobs(manifest_path, strip_batch_argv(sys.argv[1:]))
+  tick = time.time()
+  for job in jobs:
+    args = job['args']
+    if args.verbose: print('\n==== BATCH JOB {} | shape={} ===='.format(job['index'], job['shape']))
+    try:
+      run_job()
+      flush_outputs()
+    except Exception as e:
+      print('batch job {} failed: {}'.format(job['index'], e))
+      failed.append(job['index'])
+  close_stylizers()
+  close_outputs()
+  close_log()
+  tock = time.time()
+  print('Batch finished {} jobs ({} failed) in {}s'.format(len(manifest), len(failed), tock - tick))
+  if failed:
+    print('failed jobs: {}'.format(sorted(failed)))
+
+def main():
+  tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR) # quiet TF errors
+  global args
+  args = parse_args()
+  if args.batch is not None:
+    run_batch(args.batch)
+  else:
+    try:
+      run_job()
+    finally:
+      close_stylizers()
+      close_outputs()
+      close_log()
 
 if __name__ == '__main__':
   main()
@@ -0,0 +1,216 @@
+import multiprocessing
+import collections
+import argparse
+import queue
+import time
+import sys
+import os
+
+import neural_style
+
+'''
+  multi-process job scheduler
+
+  runs the jobs of a --batch style manifest on long-lived worker processes,
+  each pinned to a disjoint set of cpu cores with matching tensorflow thread
+  counts, so concurrent jobs do not oversubscribe the machine.  a job's core
+  share is sized from its --max_size (work grows with image area): jobs are
+  run in phases from the largest share down, and each phase splits the box
+  into workers of that share, so one 1024px job takes the whole box while
+  many small jobs share it.  within a phase jobs are queued grouped by shape
+  and graph, and workers keep their stylizers built between jobs.
+
+  the worker pool is also used by server.py.
+
+  python3 scheduler.py jobs.json --verbose --max_iterations 500
+'''
+def parse_args():
+  desc = 'Run a manifest of neural_style.py jobs on partitioned cpu cores.'
+  parser = argparse.ArgumentParser(description=desc)
+
+  parser.add_argument('manifest', type=str,
+    help='JSON or CSV job manifest (same format as neural_style.py --batch).')
+
+  parser.add_argument('--cores', type=int,
+    help='Number of cpu cores to schedule on. (default: all cores available to this process)')
+
+  parser.add_argument('--full_size', type=int,
+    default=1024,
+    help='Image size that gets every core; smaller jobs get a share proportional to area. (default: %(default)s)')
+
+  parser.add_argument('--max_workers', type=int,
+    help='Maximum number of worker processes, i.e. jobs running at once. (default: limited by cores only)')
+
+  parser.add_argument('--graph_cache', type=int,
+    default=4,
+    help='Graphs and sessions each worker keeps built, least recently used evicted first. (default: %(default)s)')
+
+  # remaining options are passed to every job as neural_style.py defaults
+  sched_args, job_argv = parser.parse_known_args()
+  return sched_args, job_argv
+
+def get_available_cores():
+  if hasattr(os, 'sched_getaffinity'):
+    return sorted(os.sched_getaffinity(0))
+  return list(range(os.cpu_count()))
+
+def cores_for_size(max_size, total, full_size):
+  share = min(1., (float(max_size) / float(full_size))**2)
+  return max(1, min(total, int(round(total * share))))
+
+def partition_cores(cores, n_workers):
+  # contiguous runs of cores so a worker shares caches with itself
+  share = max(1, len(cores) // n_workers)
+  return [cores[(i * share) % len(cores):][:share] for i in range(n_workers)]
+
+'''
+  worker processes
+'''
+def run_worker(index, cores, base_argv, graph_cache, render, progress, job_queue, events):
+  # renders queued (id, job) items with render(argv) until it gets None
+  if hasattr(os, 'sched_setaffinity'):
+    os.sched_setaffinity(0, cores)
+  neural_style.tf.compat.v1.logging.set_verbosity(neural_style.tf.compat.v1.logging.ERROR)
+  neural_style.max_cached_stylizers = max(1, graph_cache)
+  current = [None]
+  def forward_progress(record):
+    if record['event'] == 'iteration':
+      events.put((current[0], 'progress', {'iteration': record['iteration'],
+        'loss': record['loss'], 'time': record['time']}))
+  if progress:
+    neural_style.record_listeners.append(forward_progress)
+  thread_argv = ['--intra_op_threads', str(len(cores)), '--inter_op_threads', '1']
+  try:
+    while True:
+      item = job_queue.get()
+      if item is None:
+        return
+      current[0], job = item
+      events.put((current[0], 'started', index))
+      tick = time.time()
+      try:
+        result = render(base_argv + neural_style.job_to_argv(job) + thread_argv)
+        events.put((current[0], 'done', dict(result, time=time.time() - tick)))
+      except Exception as e:
+        events.put((current[0], 'failed', '{}: {}'.format(type(e).__name__, e)))
+  finally:
+    neural_style.close_stylizers()
+    neural_style.close_outputs()
+    neural_style.close_log()
+
+class WorkerPool(object):
+
+  def __init__(self, partitions, base_argv, graph_cache, render, progress=False):
+    # spawn so workers never inherit a forked tensorflow runtime
+    self.ctx = multiprocessing.get_context('spawn')
+    self.job_queue = self.ctx.Queue()
+    self.events = self.ctx.Queue()
+    self.worker_args = (base_argv, graph_cache, render, progress, self.job_queue, self.events)
+    self.cores = partitions
+    self.processes = [None] * len(partitions)
+    self.closing = False
+    for index in range(len(partitions)):
+      self.start(index)
+
+  def start(self, index):
+    process = self.ctx.Process(target=run_worker,
+      args=(index, self.cores[index]) + self.worker_args)
+    process.start()
+    self.processes[index] = process
+    print('worker {} started on cores {}'.format(index, self.cores[index]))
+
+  def restart_dead(self):
+    # restarts exited workers and returns (index, exit code) of each
+    dead = []
+    for index, process in enumerate(self.processes):
+      if not process.is_alive() and not self.closing:
+        print('worker {} exited with code {}, restarting'.format(index, process.exitcode))
+        dead.append((index, process.exitcode))
+        self.start(index)
+    return dead
+
+  def close(self):
+    self.closing = True
+    for _ in self.processes:
+      self.job_queue.put(None)
+    for process in self.processes:
+      process.join()
+
+def render_batch_job(argv):
+  neural_style.args = neural_style.parse_args(argv)
+  neural_style.run_job()
+  neural_style.flush_outputs()
+  return {}
+
+'''
+  scheduling
+'''
+def run_phase(jobs, partitions, base_argv, graph_cache):
+  # runs jobs on one pool of workers and returns the failed job indices
+  pool = WorkerPool(partitions, base_argv, graph_cache, render_batch_job)
+  for job in jobs:
+    pool.job_queue.put((job['index'], job['job']))
+  running = {} # job index -> worker
+  failed = []
+  remaining = len(jobs)
+  try:
+    while remaining:
+      try:
+        index, kind, payload = pool.events.get(timeout=1.)
+      except queue.Empty:
+        for worker, code in pool.restart_dead():
+          for index in [i for i, w in running.items() if w == worker]:
+            print('job {} failed: worker {} exited with code {}'.format(index, worker, code))
+            del running[index]
+            failed.append(index)
+            remaining -= 1
+        continue
+      if kind == 'started':
+        running[index] = payload
+        print('job {} started on worker {}'.format(index, payload))
+        continue
+      del running[index]
+      remaining -= 1
+      if kind == 'done':
+        print('job {} finished in {:.1f}s'.format(index, payload['time']))
+      else:
+        print('job {} failed: {}'.format(index, payload))
+        failed.append(index)
+  finally:
+    pool.close()
+  return failed
+
+def main():
+  sched_args, base_argv = parse_args()
+  all_cores = get_available_cores()
+  if sched_args.cores is not None:
+    all_cores = all_cores[:sched_args.cores]
+  total = len(all_cores)
+
+  manifest, jobs, failed = neural_style.load_batch_jobs(sched_args.manifest, base_argv)
+  # one phase per core share, largest first; jobs keep their shape order
+  phases = collections.OrderedDict()
+  for job in sorted(jobs, key=lambda job: -cores_for_size(job['args'].max_size, total,
+      sched_args.full_size)):
+    share = cores_for_size(job['args'].max_size, total, sched_args.full_size)
+    phases.setdefault(share, []).append(job)
+
+  tick = time.time()
+  for share, phase_jobs in phases.items():
+    n_workers = min(total // share, len(phase_jobs))
+    if sched_args.max_workers is not None:
+      n_workers = max(1, min(n_workers, sched_args.max_workers))
+    print('running {} jobs on {} workers of {} cores'.format(len(phase_jobs), n_workers, share))
+    failed += run_phase(phase_jobs, partition_cores(all_cores, n_workers), base_argv,
+      sched_args.graph_cache)
+  tock = time.time()
+
+  elapsed = tock - tick
+  print('Scheduled {} jobs ({} failed) on {} cores in {:.1f}s: {:.1f} jobs/hour'.format(
+    len(manifest), len(failed), total, elapsed, 3600. * len(manifest) / max(elapsed, 1e-9)))
+  if failed:
+    print('failed jobs: {}'.format(sorted(failed)))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
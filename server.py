@@ -0,0 +1,331 @@
+import urllib.parse
+import http.server
+import collections
+import threading
+import argparse
+import queue
+import json
+import time
+import os
+
+import cv2
+
+import neural_style
+import scheduler
+
+'''
+  resident stylization server
+
+  keeps worker processes with tensorflow imported, the weight cache mapped
+  and a bounded number of recently used graphs built, so a request only
+  pays for its own optimization.  jobs take the image, size, loss weight,
+  layer, optimizer and iteration keys of a --batch manifest entry (paths,
+  caches and outputs stay as given on the server's command line), are queued and run on a fixed pool of workers pinned to disjoint
+  cpu cores.  progress is streamed as json lines and the output is returned
+  as png bytes.  only localhost is served by default; there is no auth.
+
+  python3 server.py --workers 2 --max_size 256 --optimizer adam --max_iterations 200
+  curl -X POST localhost:8765/jobs -d '{"content_img": "lion.jpg", "style_imgs": ["wave.jpg"]}'
+  curl localhost:8765/jobs/1/progress
+  curl -o out.png 'localhost:8765/jobs/1/image?wait=1'
+'''
+def parse_args():
+  desc = 'Serve neural_style.py jobs over localhost HTTP from resident workers.'
+  parser = argparse.ArgumentParser(description=desc)
+
+  parser.add_argument('--host', type=str,
+    default='127.0.0.1',
+    help='Address to listen on. (default: %(default)s)')
+
+  parser.add_argument('--port', type=int,
+    default=8765,
+    help='Port to listen on. (default: %(default)s)')
+
+  parser.add_argument('--workers', type=int,
+    default=1,
+    help='Worker processes, i.e. jobs optimized at the same time. (default: %(default)s)')
+
+  parser.add_argument('--cores', type=int,
+    help='Number of cpu cores split between the workers. (default: all cores available to this process)')
+
+  parser.add_argument('--max_queue', type=int,
+    default=16,
+    help='Queued jobs accepted before new ones are refused with 503. (default: %(default)s)')
+
+  parser.add_argument('--graph_cache', type=int,
+    default=4,
+    help='Graphs and sessions each worker keeps built, least recently used evicted first. Weights and Adam settings do not need their own graph. (default: %(default)s)')
+
+  parser.add_argument('--keep_jobs', type=int,
+    default=100,
+    help='Finished jobs (and their images) kept for status and image requests. (default: %(default)s)')
+
+  # remaining options are passed to every job as neural_style.py defaults
+  server_args, job_argv = parser.parse_known_args()
+  return server_args, job_argv
+
+'''
+  jobs
+'''
+# options a job may set; the rest (directories, caches, logs, outputs and
+# performance settings) come from the server's own command line
+JOB_OPTIONS = ('content_img', 'style_imgs', 'style_imgs_weights', 'max_size',
+  'content_weight', 'style_weight', 'tv_weight', 'content_layers', 'style_layers',
+  'content_layer_weights', 'style_layer_weights', 'style_sample_rates',
+  'style_sample_mode', 'seed', 'backbone', 'optimizer', 'learning_rate', 'beta1',
+  'beta2', 'epsilon', 'lbfgs_impl', 'lbfgs_history', 'lbfgs_line_search', 'stop_window',
+  'stop_rel_tol', 'stop_loss', 'time_budget', 'blocks', 'max_iterations',
+  'print_iterations')
+
+UNSUPPORTED_JOB_OPTIONS = 'server jobs render one image with adam or lbfgs ' \
+  '(no --batch, --video_input, --tile_size, --pyramid_levels or --optimizer both)'
+
+def check_job(base_argv, job):
+  if not isinstance(job, dict):
+    raise ValueError('a job is a JSON object of neural_style.py options')
+  for key in job:
+    if key not in JOB_OPTIONS:
+      raise ValueError('server jobs cannot set {} (options: {})'.format(key,
+        ', '.join(JOB_OPTIONS)))
+  # images are names inside the server's --content_img_dir and --style_imgs_dir
+  names = job.get('style_imgs', [])
+  names = [names] if not isinstance(names, list) else names
+  for name in [job.get('content_img', '')] + names:
+    name = str(name)
+    if os.path.basename(name) != name or name in ('.', '..'):
+      raise ValueError('image names cannot contain directories: {}'.format(name))
+  try:
+    job_args = neural_style.parse_args(base_argv + neural_style.job_to_argv(job))
+  except SystemExit:
+    raise ValueError('invalid job options: {}'.format(json.dumps(job)))
+  if job_args.batch is not None or job_args.video_input is not None or \
+      job_args.tile_size > 0 or job_args.pyramid_levels > 1 or job_args.optimizer == 'both':
+    raise ValueError(UNSUPPORTED_JOB_OPTIONS)
+
+class JobTable(object):
+  # job records shared by the http threads and the event pump
+
+  def __init__(self, max_queue, keep_jobs):
+    self.jobs = collections.OrderedDict()
+    self.cond = threading.Condition()
+    self.max_queue = max_queue
+    self.keep_jobs = keep_jobs
+    self.next_id = 1
+
+  def add(self, job, job_queue):
+    with self.cond:
+      queued = sum(1 for record in self.jobs.values() if record['state'] == 'queued')
+      if queued >= self.max_queue:
+        return None
+      job_id = self.next_id
+      self.next_id += 1
+      self.jobs[job_id] = {'id': job_id, 'job': job, 'state': 'queued',
+        'submitted': time.time(), 'worker': None, 'events': [], 'image': None}
+      job_queue.put((job_id, job))
+      return job_id
+
+  def update(self, job_id, kind, payload):
+    with self.cond:
+      record = self.jobs.get(job_id)
+      if record is None:
+        return
+      if kind == 'progress':
+        record['events'].append(dict(payload, event='progress'))
+      elif kind == 'started':
+        record['state'] = 'running'
+        record['worker'] = payload
+        record['events'].append({'event': 'started', 'worker': payload,
+          'queued_time': time.time() - record['submitted']})
+      elif kind == 'done':
+        record['state'] = 'done'
+        record['image'] = payload['image']
+        record['run_info'] = payload['run_info']
+        record['events'].append({'event': 'done', 'time': payload['time'],
+          'phases': payload['phases']})
+      elif kind == 'failed':
+        record['state'] = 'failed'
+        record['error'] = payload
+        record['events'].append({'event': 'failed', 'error': payload})
+      if record['state'] in ('done', 'failed'):
+        self.evict()
+      self.cond.notify_all()
+
+  def fail_worker(self, worker, error):
+    with self.cond:
+      running = [job_id for job_id, record in self.jobs.items()
+        if record['state'] == 'running' and record['worker'] == worker]
+    for job_id in running:
+      self.update(job_id, 'failed', error)
+
+  def evict(self):
+    finished = [job_id for job_id, record in self.jobs.items()
+      if record['state'] in ('done', 'failed')]
+    for job_id in finished[:max(0, len(finished) - self.keep_jobs)]:
+      del self.jobs[job_id]
+
+  def status(self, job_id):
+    with self.cond:
+      record = self.jobs.get(job_id)
+      if record is None:
+        return None
+      status = dict((key, value) for key, value in record.items()
+        if key not in ('events', 'image'))
+      progress = [e for e in record['events'] if e['event'] == 'progress']
+      if progress:
+        status['iteration'] = progress[-1]['iteration']
+        status['loss'] = progress[-1]['loss']
+      return status
+
+  def wait_events(self, job_id, seen):
+    # blocks until there are events past seen or the job has finished
+    with self.cond:
+      while True:
+        record = self.jobs.get(job_id)
+        if record is None:
+          return [], 'evicted'
+        if len(record['events']) > seen or record['state'] in ('done', 'failed'):
+          return record['events'][seen:], record['state']
+        self.cond.wait()
+
+  def wait_image(self, job_id, wait):
+    with self.cond:
+      while True:
+        record = self.jobs.get(job_id)
+        if record is None or record['state'] in ('done', 'failed') or not wait:
+          return record
+        self.cond.wait()
+
+'''
+  worker processes (scheduler.WorkerPool)
+'''
+def render_job(argv):
+  neural_style.args = neural_style.parse_args(argv + ['--output_workers', '0'])
+  neural_style.reset_phase_times()
+  content_img = neural_style.get_content_image(neural_style.args.content_img)
+  style_imgs = neural_style.get_style_images(content_img)
+  output_img = neural_style.stylize(content_img, style_imgs, content_img)
+  neural_style.flush_outputs() # --save_iters images
+  ok, png = cv2.imencode('.png', neural_style.postprocess(output_img))
+  if not ok:
+    raise RuntimeError('could not encode the output image')
+  return {'image': png.tobytes(), 'phases': dict(neural_style.phase_times),
+    'run_info': json.loads(json.dumps(neural_style.run_info, default=str))}
+
+def pump(pool, table):
+  # moves worker events into the job table and replaces dead workers
+  while not pool.closing:
+    try:
+      job_id, kind, payload = pool.events.get(timeout=1.)
+      table.update(job_id, kind, payload)
+    except queue.Empty:
+      pass
+    for index, code in pool.restart_dead():
+      table.fail_worker(index, 'worker exited with code {}'.format(code))
+
+'''
+  http api
+'''
+class JobHandler(http.server.BaseHTTPRequestHandler):
+
+  def do_POST(self):
+    if urllib.parse.urlsplit(self.path).path.rstrip('/') != '/jobs':
+      return self.send_json(404, {'error': 'not found'})
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      job = json.loads(self.rfile.read(length).decode('utf-8'))
+      check_job(self.server.base_argv, job)
+    except ValueError as e:
+      return self.send_json(400, {'error': str(e)})
+    job_id = self.server.table.add(job, self.server.pool.job_queue)
+    if job_id is None:
+      return self.send_json(503, {'error': 'queue full'})
+    self.send_json(202, {'id': job_id})
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    parts = url.path.strip('/').split('/')
+    if len(parts) < 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+      return self.send_json(404, {'error': 'not found'})
+    job_id = int(parts[1])
+    if self.server.table.status(job_id) is None:
+      return self.send_json(404, {'error': 'unknown job {}'.format(job_id)})
+    if len(parts) == 2:
+      self.send_json(200, self.server.table.status(job_id))
+    elif parts[2:] == ['progress']:
+      self.stream_progress(job_id)
+    elif parts[2:] == ['image']:
+      wait = urllib.parse.parse_qs(url.query).get('wait', ['0'])[0] not in ('0', '')
+      self.send_image(job_id, wait)
+    else:
+      self.send_json(404, {'error': 'not found'})
+
+  def stream_progress(self, job_id):
+    # one json object per line until the job finishes; http/1.0 ends the
+    # body by closing the connection
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/x-ndjson')
+    self.end_headers()
+    seen = 0
+    try:
+      while True:
+        events, state = self.server.table.wait_events(job_id, seen)
+        for event in events:
+          self.wfile.write((json.dumps(event) + '\n').encode('utf-8'))
+        self.wfile.flush()
+        seen += len(events)
+        if state in ('done', 'failed', 'evicted') and not events:
+          return
+    except (BrokenPipeError, ConnectionResetError):
+      pass
+
+  def send_image(self, job_id, wait):
+    record = self.server.table.wait_image(job_id, wait)
+    if record is None:
+      return self.send_json(404, {'error': 'unknown job {}'.format(job_id)})
+    if record['state'] == 'failed':
+      return self.send_json(500, {'error': record['error']})
+    if record['state'] != 'done':
+      return self.send_json(409, {'error': 'job {} is {}'.format(job_id, record['state'])})
+    self.send_response(200)
+    self.send_header('Content-Type', 'image/png')
+    self.send_header('Content-Length', str(len(record['image'])))
+    self.end_headers()
+    self.wfile.write(record['image'])
+
+  def send_json(self, code, body):
+    data = json.dumps(body, default=str).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+def main():
+  server_args, base_argv = parse_args()
+  cores = scheduler.get_available_cores()
+  if server_args.cores is not None:
+    cores = cores[:server_args.cores]
+  n_workers = max(1, server_args.workers)
+
+  table = JobTable(server_args.max_queue, server_args.keep_jobs)
+  pool = scheduler.WorkerPool(scheduler.partition_cores(cores, n_workers), base_argv,
+    server_args.graph_cache, render_job, progress=True)
+  pumper = threading.Thread(target=pump, args=(pool, table), daemon=True)
+  pumper.start()
+
+  httpd = http.server.ThreadingHTTPServer((server_args.host, server_args.port), JobHandler)
+  httpd.daemon_threads = True
+  httpd.table = table
+  httpd.pool = pool
+  httpd.base_argv = base_argv
+  print('serving on http://{}:{}'.format(server_args.host, server_args.port))
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    httpd.server_close()
+    pool.close()
+
+if __name__ == '__main__':
+  main()
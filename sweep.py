@@ -0,0 +1,231 @@
+import itertools
+import argparse
+import json
+import time
+import csv
+import os
+
+import numpy as np
+
+import neural_style as ns
+
+'''
+  successive halving sweep
+
+  searches Adam settings and loss weights without one full run per grid
+  point.  every candidate gets its own input and optimizer in one graph on
+  shared weights and targets; all candidates run to the first rung, the best
+  1/eta by score go on to the next rung (eta times the iterations), and only
+  the last survivors reach --max_iterations.  candidates with different
+  loss weights optimize different objectives, so they are scored by the
+  loss of their image under the command line weights.
+
+  python3 sweep.py --space learning_rate=1,3,10,30 beta1=0.9,0.99 --content_img lion.jpg --style_imgs wave.jpg --max_size 256 --max_iterations 1000
+  python3 sweep.py --space learning_rate=loguniform:0.3:30 style_weight=1e3,1e4,1e5 --samples 27 --content_img lion.jpg --style_imgs wave.jpg
+'''
+ADAM_OPTIONS = ('learning_rate', 'beta1', 'beta2', 'epsilon')
+WEIGHT_OPTIONS = ('content_weight', 'style_weight', 'tv_weight')
+
+def parse_args():
+  desc = 'Successive halving search over Adam settings and loss weights.'
+  parser = argparse.ArgumentParser(description=desc)
+
+  parser.add_argument('--space', nargs='+', type=str,
+    required=True,
+    help='Search space as name=v1,v2,... or name=uniform:low:high or name=loguniform:low:high for {}.'.format(
+      ', '.join(ADAM_OPTIONS + WEIGHT_OPTIONS)))
+
+  parser.add_argument('--samples', type=int,
+    help='Number of random candidates. (default: the full grid, or 16 when the space has ranges)')
+
+  parser.add_argument('--min_iterations', type=int,
+    default=25,
+    help='Iterations every candidate runs before the first pruning. (default: %(default)s)')
+
+  parser.add_argument('--eta', type=int,
+    default=3,
+    help='Each rung keeps 1/eta of the candidates and multiplies the iterations by eta. (default: %(default)s)')
+
+  parser.add_argument('--output', type=str,
+    default='sweep_results',
+    help='Path prefix of the leaderboard .json/.csv, the .png plot and the _best.png image. (default: %(default)s)')
+
+  # remaining options are neural_style.py options shared by every candidate
+  sweep_args, style_argv = parser.parse_known_args()
+  try:
+    sweep_args.space = parse_space(sweep_args.space)
+  except ValueError as e:
+    parser.error(str(e))
+  if sweep_args.eta < 2:
+    parser.error('--eta must be at least 2')
+  return sweep_args, style_argv
+
+def parse_space(specs):
+  space = {}
+  for spec in specs:
+    key, _, values = spec.partition('=')
+    if key not in ADAM_OPTIONS + WEIGHT_OPTIONS:
+      raise ValueError('--space cannot search {}'.format(key))
+    if values.startswith(('uniform:', 'loguniform:')):
+      kind, low, high = values.split(':')
+      space[key] = (kind, float(low), float(high))
+    else:
+      space[key] = [float(v) for v in values.split(',')]
+  return space
+
+def get_candidates(space, samples, seed):
+  keys = sorted(space)
+  ranges = [key for key in keys if isinstance(space[key], tuple)]
+  if samples is None and not ranges:
+    return [dict(zip(keys, values)) for values in itertools.product(*[space[key] for key in keys])]
+  rng = np.random.RandomState(seed)
+  candidates = []
+  for _ in range(samples or 16):
+    candidate = {}
+    for key in keys:
+      values = space[key]
+      if isinstance(values, list):
+        candidate[key] = values[rng.randint(len(values))]
+      elif values[0] == 'uniform':
+        candidate[key] = float(rng.uniform(values[1], values[2]))
+      else:
+        candidate[key] = float(np.exp(rng.uniform(np.log(values[1]), np.log(values[2]))))
+    candidates.append(candidate)
+  return candidates
+
+def get_rungs(min_iterations, eta, max_iterations):
+  rungs = []
+  budget = min_iterations
+  while budget < max_iterations:
+    rungs.append(budget)
+    budget *= eta
+  return rungs + [max_iterations]
+
+def get_label(candidate):
+  return ', '.join('{}={:.4g}'.format(key, value) for key, value in sorted(candidate.items()))
+
+'''
+  shared graph
+'''
+@ns.timed_phase('graph_build')
+def build_sweep(content_img, candidates):
+  graph = ns.tf.Graph()
+  branches = []
+  with graph.as_default(), ns.tf.device(ns.args.device), ns.resource_variable_scope():
+    net = ns.build_model(content_img)
+    # candidates only differ in variables loaded by load_job_params
+    for index in range(len(candidates)):
+      if index == 0:
+        branch = net
+      else:
+        with ns.tf.name_scope('candidate{}'.format(index)):
+          branch = ns.build_input_net(content_img.shape, net['layer_table'], net['params'])
+      with ns.get_jit_scope():
+        L_total = ns.build_loss(branch, None if index == 0 else net)
+        _, train_op = ns.build_optimizer(branch, L_total)
+      branches.append({'net': branch, 'loss': L_total, 'train_op': train_op})
+    init_op = ns.tf.global_variables_initializer()
+  sess = ns.tf.Session(graph=graph, config=ns.get_session_config())
+  return {'graph': graph, 'sess': sess, 'net': net, 'branches': branches,
+    'init_op': init_op}
+
+def run_sweep(sweep_args, candidates):
+  content_img = ns.get_content_image(ns.args.content_img)
+  style_imgs = ns.get_style_images(content_img)
+  sweep = build_sweep(content_img, candidates)
+  sess, net = sweep['sess'], sweep['net']
+  reference = np.array([ns.args.content_weight, ns.args.style_weight, ns.args.tv_weight])
+  states = []
+  tick = time.time()
+  try:
+    with sweep['graph'].as_default(), sess.as_default():
+      sess.run(sweep['init_op'])
+      ns.set_targets(sess, net, content_img, style_imgs)
+      for candidate, branch in zip(candidates, sweep['branches']):
+        with ns.config_args(candidate):
+          ns.load_job_params(sess, branch['net'])
+        branch['net']['input'].load(content_img, sess)
+        states.append({'iterations': 0, 'time': 0., 'history': []})
+      alive = list(range(len(candidates)))
+      for rung, budget in enumerate(get_rungs(sweep_args.min_iterations, sweep_args.eta,
+          ns.args.max_iterations)):
+        for i in alive:
+          state, branch = states[i], sweep['branches'][i]
+          start = time.time()
+          for _ in range(budget - state['iterations']):
+            sess.run(branch['train_op'])
+          state['time'] += time.time() - start
+          state['iterations'] = budget
+          terms = [np.sum(term) for term in sess.run(branch['net']['loss_terms'])]
+          state['score'] = float(np.dot(reference, terms))
+          state['loss'] = float(sess.run(branch['loss'])[0])
+          state['history'].append((state['time'], state['score']))
+        alive.sort(key=lambda i: states[i]['score'])
+        if ns.args.verbose:
+          print('rung {}: {} candidates at {} iterations, best score {:.4g} ({})'.format(rung,
+            len(alive), budget, states[alive[0]]['score'], get_label(candidates[alive[0]])))
+        if budget < ns.args.max_iterations:
+          alive = alive[:max(1, len(alive) // sweep_args.eta)]
+      best_img = sess.run(sweep['branches'][alive[0]]['net']['input'])
+  finally:
+    sess.close()
+  return states, best_img, time.time() - tick
+
+'''
+  leaderboard
+'''
+def get_leaderboard(candidates, states):
+  rows = []
+  for candidate, state in zip(candidates, states):
+    rows.append(dict(candidate, config=get_label(candidate), iterations=state['iterations'],
+      score=state['score'], loss=state['loss'], time=state['time']))
+  # survivors of the latest rungs first, then by score
+  rows.sort(key=lambda row: (-row['iterations'], row['score']))
+  for rank, row in enumerate(rows):
+    row['rank'] = rank + 1
+  return rows
+
+def write_leaderboard(rows, prefix):
+  out_dir = os.path.dirname(prefix)
+  if out_dir:
+    ns.maybe_make_directory(out_dir)
+  with open(prefix + '.json', 'w') as f:
+    json.dump(rows, f, indent=2)
+  fields = ['rank', 'iterations', 'score', 'loss', 'time', 'config'] + \
+    sorted(key for key in rows[0] if key in ADAM_OPTIONS + WEIGHT_OPTIONS)
+  with open(prefix + '.csv', 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+
+def print_leaderboard(rows, wall_time, exhaustive_time, top=10):
+  print('{:>4} {:>6} {:>12} {:>9}  {}'.format('rank', 'iters', 'score', 'time(s)', 'config'))
+  for row in rows[:top]:
+    print('{:>4} {:>6} {:>12.4g} {:>9.1f}  {}'.format(row['rank'], row['iterations'],
+      row['score'], row['time'], row['config']))
+  print('Sweep of {} candidates took {:.1f}s; the full grid would take about {:.1f}s'.format(
+    len(rows), wall_time, exhaustive_time))
+
+def main():
+  sweep_args, style_argv = parse_args()
+  ns.tf.compat.v1.logging.set_verbosity(ns.tf.compat.v1.logging.ERROR)
+  ns.args = ns.parse_args(style_argv + ['--optimizer', 'adam'])
+  candidates = get_candidates(sweep_args.space, sweep_args.samples, ns.args.seed)
+  try:
+    states, best_img, wall_time = run_sweep(sweep_args, candidates)
+    rows = get_leaderboard(candidates, states)
+    write_leaderboard(rows, sweep_args.output)
+    # time per iteration at the first rung, for every candidate at the full budget
+    exhaustive_time = sum(state['history'][0][0] / sweep_args.min_iterations
+      for state in states) * ns.args.max_iterations
+    print_leaderboard(rows, wall_time, exhaustive_time)
+    curves = [(get_label(candidate), [t for t, _ in state['history']],
+      [score for _, score in state['history']])
+      for candidate, state in zip(candidates, states)]
+    ns.plot_losses(curves, sweep_args.output + '.png')
+    ns.write_image(sweep_args.output + '_best.png', best_img)
+  finally:
+    ns.close_outputs()
+
+if __name__ == '__main__':
+  main()